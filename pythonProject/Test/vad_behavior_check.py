@@ -0,0 +1,74 @@
+"""
+反欺诈 VAD（能量 + 过零率）在合成信号上的行为检查
+用法（在 pythonProject 目录下）：python Test/vad_behavior_check.py
+只依赖 numpy；检查人声占比是否落在预期区间，尤其是没有静音的连续语音 / TTS 不能被判为无效
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1] / "app"
+sys.path.insert(0, str(ROOT))
+
+from module.anti_spoof.vad import speech_segments
+
+SR = 16000
+MIN_SPEECH_RATIO = 0.3  # 与 ANTI_SPOOF_MIN_SPEECH_RATIO 默认值一致
+rng = np.random.default_rng(0)
+
+
+def voiced(seconds, f0=140.0, level_db=-20.0, syllable_hz=4.0):
+    """类人声：基频 + 谐波，按音节频率做幅度调制"""
+    t = np.arange(int(seconds * SR)) / SR
+    x = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 8))
+    env = 0.6 + 0.4 * np.sin(2 * np.pi * syllable_hz * t) ** 2
+    x = x * env
+    return (x / np.sqrt(np.mean(x * x)) * 10 ** (level_db / 20)).astype(np.float32)
+
+
+def tone(seconds, freq=220.0, level_db=-20.0):
+    """恒定幅度的正弦（合成语音 / 回铃音那种几乎没有能量起伏的信号）"""
+    t = np.arange(int(seconds * SR)) / SR
+    return (np.sqrt(2) * 10 ** (level_db / 20) * np.sin(2 * np.pi * freq * t)).astype(np.float32)
+
+
+def noise(seconds, level_db=-60.0):
+    return (rng.standard_normal(int(seconds * SR)) * 10 ** (level_db / 20)).astype(np.float32)
+
+
+def speech_ratio(x):
+    return sum(e - s for s, e in speech_segments(x, SR)) / x.size
+
+
+def check(name, x, lo, hi):
+    ratio = speech_ratio(x)
+    ok = lo <= ratio <= hi
+    print(f"{'OK  ' if ok else 'FAIL'} {name}: speech_ratio {ratio:.2f} (expected {lo:.2f}..{hi:.2f})")
+    return ok
+
+
+def main():
+    results = [
+        # 纯静音 / 底噪：没有人声
+        check("digital silence", np.zeros(4 * SR, dtype=np.float32), 0.0, 0.0),
+        check("noise floor -60dB", noise(4), 0.0, 0.05),
+        # 人声与静音交替：大约一半
+        check("speech/silence alternating",
+              np.concatenate([voiced(1), noise(1), voiced(1), noise(1)]) + noise(4), 0.4, 0.7),
+        # 开头一小段人声、后面都是静音：低于门限
+        check("short speech then silence", np.concatenate([voiced(0.5), noise(4.5)]), 0.0, MIN_SPEECH_RATIO - 0.01),
+        # 没有停顿的连续语音 / TTS：必须判为有人声
+        check("continuous speech", voiced(4), 0.95, 1.0),
+        check("continuous speech, loud", voiced(4, level_db=-6.0), 0.95, 1.0),
+        check("continuous speech, quiet", voiced(4, level_db=-30.0), 0.95, 1.0),
+        check("continuous speech over noise", voiced(4) + noise(4, -45.0), 0.95, 1.0),
+        check("continuous tone", tone(4), 0.95, 1.0),
+        check("continuous high tone", tone(4, freq=3000.0), 0.95, 1.0),
+    ]
+    print("all passed" if all(results) else "FAILED")
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
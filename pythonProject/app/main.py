@@ -1,12 +1,35 @@
 # main.py
-from fastapi import FastAPI, Header, HTTPException, Depends, UploadFile, File, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Header, HTTPException, Depends, WebSocket, WebSocketDisconnect, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from typing import Literal, Optional, List, Dict, Any
-import os, json, math, asyncio, tempfile
+import os, json, math, asyncio, time
 from pathlib import Path
 import httpx
 
+try:  # python-multipart：FastAPI 表单解析同一个依赖，新版本改了包名
+    from python_multipart.multipart import MultipartParser, parse_options_header
+    from python_multipart.exceptions import MultipartParseError
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
+    from multipart.exceptions import MultipartParseError
+
+from utils.auth_cache import AuthCache, token_key
+from utils.http_pool import HttpPools
+from utils.jwt_local import LocalJWTVerifier, LocalJWTError, LocalKeyUnavailable
+from utils.llm_stream import OllamaStream, UpstreamError
+from utils.stream_utils import coalesce_config, coalesce_config_from_query, coalesce_deltas, with_heartbeat
+from utils.ws_outbox import WSOutbox, BACKPRESSURE_STATS, SlowConsumerError
+from utils.metrics import REGISTRY, WS_AUTH_SECONDS, ANTI_SPOOF_QUEUE_WAIT_SECONDS, ANTI_SPOOF_INFER_SECONDS, StreamTimer
+from utils.stream_buffer import StreamBuffer, StreamRegistry, ResumeGap
+from utils.answer_cache import AnswerCache, CachingStream, normalize_query
+from utils.singleflight import SingleFlight
+from utils.admission import Admission, AdmissionRejected
+from utils.provider_router import ProviderRouter, RoutedStream
+from utils.bounded_executor import BoundedExecutor, ExecutorSaturated
+from module.anti_spoof.streaming import StreamingWindower
+
 
 # =========================
 # 配置（可用环境变量覆盖）
@@ -14,11 +37,32 @@ import httpx
 AUTH_BASE_URL = os.getenv("AUTH_BASE_URL", "http://192.168.2.30:8080")
 AUTH_VALIDATE_PATH = os.getenv("AUTH_VALIDATE_PATH", "/api/auth/validate")
 AUTH_TIMEOUT_S = float(os.getenv("AUTH_TIMEOUT_S", "5.0"))
+AUTH_CACHE_MAX_TTL_S = float(os.getenv("AUTH_CACHE_MAX_TTL_S", "60"))
+AUTH_CACHE_NEG_TTL_S = float(os.getenv("AUTH_CACHE_NEG_TTL_S", "5"))
+AUTH_CACHE_MAX_SIZE = int(os.getenv("AUTH_CACHE_MAX_SIZE", "10000"))
+AUTH_MODE = os.getenv("AUTH_MODE", "remote").lower()
+AUTH_JWT_ALG = os.getenv("AUTH_JWT_ALG", "HS256")
+AUTH_JWT_SECRET = os.getenv("AUTH_JWT_SECRET")
+AUTH_JWT_PUBLIC_KEY_PATH = os.getenv("AUTH_JWT_PUBLIC_KEY_PATH")
+AUTH_JWT_JWKS_PATH = os.getenv("AUTH_JWT_JWKS_PATH")
+AUTH_JWT_LEEWAY_S = float(os.getenv("AUTH_JWT_LEEWAY_S", "0"))
+AUTH_LOCAL_FALLBACK = os.getenv("AUTH_LOCAL_FALLBACK", "1") == "1"
+AUTH_REVOCATION_CHECK_S = float(os.getenv("AUTH_REVOCATION_CHECK_S", "0"))
 
 """
 AUTH_BASE_URL        验证服务基础URL，后端地址
 AUTH_VALIDATE_PATH   验证Token的接口路径
 AUTH_TIMEOUT_S       服务超时时间 
+AUTH_CACHE_MAX_TTL_S 验证结果最长缓存时间（同时不会超过 token 的 exp），0 表示关闭缓存
+AUTH_CACHE_NEG_TTL_S 无效 token 的缓存时间
+AUTH_CACHE_MAX_SIZE  缓存条目上限（LRU 淘汰）
+AUTH_MODE            remote=调用后端验证；local=本地验签（HS256 共享密钥 / RS256 公钥或 JWKS）
+AUTH_JWT_*           本地验签参数：ALG、SECRET、PUBLIC_KEY_PATH、JWKS_PATH、LEEWAY_S
+AUTH_LOCAL_FALLBACK  本地验签器不可用或找不到 kid 时，是否退回远程验证
+AUTH_REVOCATION_CHECK_S  >0 时，本地验签通过的 token 每隔 N 秒在后台调用后端检查一次是否被吊销
+
+上游连接池（auth / rag 各一个）的连接数、keep-alive、超时见 utils/http_pool.py，
+例如 RAG_MAX_CONNECTIONS、RAG_KEEPALIVE_EXPIRY_S、RAG_TIMEOUT_S、AUTH_MAX_KEEPALIVE
 """
 
 def _auth_url() -> str:
@@ -39,18 +83,101 @@ class RAGService(BaseModel):
 # =========================
 # 鉴权工具
 # =========================
+http_pools = HttpPools()  # 上游连接池，startup 时创建
+
+auth_cache = AuthCache(max_ttl=AUTH_CACHE_MAX_TTL_S,
+                       neg_ttl=AUTH_CACHE_NEG_TTL_S,
+                       max_size=AUTH_CACHE_MAX_SIZE)
+
+local_verifier: Optional[LocalJWTVerifier] = None  # AUTH_MODE=local 时在 startup 创建
+# 本地验签模式下的吊销检查结果：过期即重新检查
+revocation_cache = AuthCache(max_ttl=AUTH_REVOCATION_CHECK_S,
+                             neg_ttl=AUTH_REVOCATION_CHECK_S,
+                             max_size=AUTH_CACHE_MAX_SIZE)
+_revocation_pending: set = set()
+_revocation_tasks: set = set()  # 正在进行的后台吊销检查任务
+
 async def jwt_val(token: str) -> Dict[str, Any]:
     """
     JWT鉴权
+    - AUTH_MODE=local：本地验签，不走网络；必要时退回远程验证
+    - 其余情况：先查缓存，未命中再调用后端验证
     :param token: 鉴权token
     :return:  data  # 可包含 username/roles/tenant 等
     """
-    url = _auth_url()
-    async with httpx.AsyncClient(timeout=AUTH_TIMEOUT_S) as client:
+    if AUTH_MODE == "local":
+        if local_verifier is not None:
+            try:
+                data = local_verifier.verify(token)
+            except LocalKeyUnavailable:
+                if not AUTH_LOCAL_FALLBACK:
+                    raise HTTPException(status_code=401, detail="Invalid token")
+            except LocalJWTError:
+                raise HTTPException(status_code=401, detail="Invalid token")
+            else:
+                _check_revocation(token)
+                return data
+        elif not AUTH_LOCAL_FALLBACK:
+            raise HTTPException(status_code=503, detail="Local token verifier unavailable")
+
+    cached = auth_cache.get(token)
+    if cached is not None:
+        valid, data = cached
+        if valid:
+            return data
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    try:
+        data = await _remote_jwt_val(token)
+    except HTTPException as e:
+        if e.status_code == 401:
+            auth_cache.put(token, False)  # 只缓存"token 无效"，服务不可用(503)不缓存
+        raise
+    auth_cache.put(token, True, data)
+    return data
+
+def _check_revocation(token: str) -> None:
+    """
+    本地验签通过后的吊销检查：
+    - 已知被吊销：直接 401
+    - 检查结果过期：后台调用后端重新验证，本次请求不等待
+    """
+    if AUTH_REVOCATION_CHECK_S <= 0:
+        return
+    cached = revocation_cache.get(token)
+    if cached is not None:
+        if not cached[0]:
+            raise HTTPException(status_code=401, detail="Token revoked")
+        return
+    key = token_key(token)
+    if key in _revocation_pending:
+        return
+    _revocation_pending.add(key)
+
+    async def _run():
         try:
-            resp = await client.post(url, json={"token": token})  # 调用后端接口验证JWT
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=503, detail=f"Authentication service unavailable: {e}") # 抛出503错误，提示连接错误，和tokeb没有关系
+            await _remote_jwt_val(token)
+            revocation_cache.put(token, True)
+        except HTTPException as e:
+            if e.status_code == 401:
+                revocation_cache.put(token, False)
+        finally:
+            _revocation_pending.discard(key)
+
+    task = asyncio.create_task(_run())
+    _revocation_tasks.add(task)  # 保留引用，避免任务执行中被垃圾回收
+    task.add_done_callback(_revocation_tasks.discard)
+
+async def _remote_jwt_val(token: str) -> Dict[str, Any]:
+    """
+    调用后端 /api/auth/validate 验证 JWT
+    """
+    url = _auth_url()
+    client = http_pools.get("auth")
+    try:
+        resp = await client.post(url, json={"token": token})  # 调用后端接口验证JWT
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=503, detail=f"Authentication service unavailable: {e}") # 抛出503错误，提示连接错误，和tokeb没有关系
     if resp.status_code == 200:
         data = resp.json() # 获取返回JWT验证结果
         if data.get("valid"):
@@ -100,24 +227,80 @@ app.add_middleware(
 async def root():
     return {"message": "服务正在运行喵"}
 
+@app.get("/auth/cache_stats")
+async def auth_cache_stats():
+    """
+    JWT 验证缓存命中情况
+    """
+    return auth_cache.stats()
+
+# =========================
+# 指标（Prometheus 文本格式）
+# =========================
+REGISTRY.gauge_map("auth_cache_lookups", "JWT 验证缓存命中/未命中次数", "result",
+                   lambda: {"hit": auth_cache.hits, "miss": auth_cache.misses})
+REGISTRY.gauge_map("ws_backpressure_events", "WebSocket 慢消费者事件计数", "event",
+                   lambda: dict(BACKPRESSURE_STATS))
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 # =========================
 # 实例化
 # =========================
 from schemas import *
 
+ds = None        # AsyncDeepseekStreamer，startup 时创建
+detector = None  # AASISTDetector，startup 时创建
+
+@app.on_event("startup")
+async def _init_http_pools():
+    """
+    每个上游一个长连接池，所有请求复用，避免每次请求重新握手
+    """
+    http_pools.open("auth", "AUTH", AUTH_TIMEOUT_S)
+    http_pools.open("rag", "RAG", 30.0)
+
+@app.on_event("startup")
+def _init_local_auth():
+    """
+    AUTH_MODE=local 时加载本地验签密钥；失败时打印原因，按 AUTH_LOCAL_FALLBACK 决定是否退回远程验证
+    """
+    global local_verifier
+    if AUTH_MODE != "local":
+        return
+    try:
+        local_verifier = LocalJWTVerifier(
+            algorithm=AUTH_JWT_ALG,
+            secret=AUTH_JWT_SECRET,
+            public_key_path=AUTH_JWT_PUBLIC_KEY_PATH,
+            jwks_path=AUTH_JWT_JWKS_PATH,
+            leeway=AUTH_JWT_LEEWAY_S,
+        )
+        print(f"[startup] 本地验签已启用：{AUTH_JWT_ALG}")
+    except Exception as e:
+        print(f"[startup] Local JWT verifier init failed: {e}")
+
+@app.on_event("shutdown")
+async def _close_http_pools():
+    await http_pools.aclose()
+
 @app.on_event("startup")
 def _lazy_init_heavy_components():
     """
     启动后再加载重组件，避免 import 阶段阻塞 / 根路由。
     """
-    from module.Alternatives_API.API import DeepseekStreamer
+    from module.Alternatives_API.API import AsyncDeepseekStreamer
     from module.anti_spoof.inference import AASISTDetector
     global ds, detector
     ROOT = Path(__file__).resolve().parent
 
     # 先把服务跑起来，再加载 deepseek（如果它初始化会访问网络，就不会卡住启动）
+    # 异步版本 + 共享连接池，/ws 里直接 async for，不会阻塞事件循环
     try:
-        ds = DeepseekStreamer(model="deepseek-chat")
+        ds = AsyncDeepseekStreamer(model="deepseek-chat",
+                                   http_client=http_pools.open("deepseek", "DEEPSEEK", 60.0))
         print("[startup] DeepseekStreamer 准备好了")
     except Exception as e:
         print(f"[startup] Deepseek init failed: {e}")
@@ -132,7 +315,21 @@ def _lazy_init_heavy_components():
             weight_path=str(ckpt),
             use_cuda=False,
             min_duration_sec=2.0,
-            vad=False
+            vad=ANTI_SPOOF_VAD,
+            vad_trim=ANTI_SPOOF_VAD_TRIM,
+            min_speech_ratio=ANTI_SPOOF_MIN_SPEECH_RATIO,
+            batch_size=ANTI_SPOOF_BATCH_SIZE,
+            batch_wait_ms=ANTI_SPOOF_BATCH_WAIT_MS,
+            segmented=ANTI_SPOOF_SEGMENTED,
+            segment_hop=ANTI_SPOOF_SEGMENT_HOP or None,
+            segment_batch=ANTI_SPOOF_SEGMENT_BATCH,
+            aggregate=ANTI_SPOOF_AGGREGATE,
+            quantile=ANTI_SPOOF_AGG_QUANTILE,
+            early_exit=ANTI_SPOOF_EARLY_EXIT,
+            resample_fast=ANTI_SPOOF_RESAMPLE_FAST,
+            backend=ANTI_SPOOF_BACKEND,
+            artifact_path=ANTI_SPOOF_ARTIFACT,
+            ort_threads=ANTI_SPOOF_ORT_THREADS,
         )
         print("[startup] AASISTDetector 准备好了")
     except Exception as e:
@@ -140,28 +337,148 @@ def _lazy_init_heavy_components():
         print(f"[startup] AASIST init failed: {e}")
         # 也可以选择 raise，让启动直接失败
 
+# =========================
+# LLM 准入控制（用户限流 + 上游并发上限）
+# =========================
+LLM_USER_RATE_PER_MIN = float(os.getenv("LLM_USER_RATE_PER_MIN", "30"))  # 每个用户每分钟请求数，0 表示不限
+LLM_USER_BURST = int(os.getenv("LLM_USER_BURST", "10"))                  # 令牌桶容量（允许的突发）
+LLM_MAX_CONCURRENCY_OLLAMA = int(os.getenv("LLM_MAX_CONCURRENCY_OLLAMA", "8"))
+LLM_MAX_CONCURRENCY_DEEPSEEK = int(os.getenv("LLM_MAX_CONCURRENCY_DEEPSEEK", "32"))
+LLM_QUEUE_TIMEOUT_S = float(os.getenv("LLM_QUEUE_TIMEOUT_S", "5"))      # 排队等待上游槽位的最长时间
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))                    # 每个上游最多排队数，超过直接 503
+
+admission = Admission(rate_per_min=LLM_USER_RATE_PER_MIN,
+                      burst=LLM_USER_BURST,
+                      limits={"ollama": LLM_MAX_CONCURRENCY_OLLAMA, "deepseek": LLM_MAX_CONCURRENCY_DEEPSEEK},
+                      queue_timeout_s=LLM_QUEUE_TIMEOUT_S,
+                      max_queue=LLM_MAX_QUEUE)
+REGISTRY.gauge_map("llm_admission_rejections", "准入控制拒绝次数", "reason",
+                   lambda: admission.stats()["rejections"])
+REGISTRY.gauge_map("llm_upstream_active", "各上游正在进行的生成数", "upstream",
+                   lambda: {k: v["active"] for k, v in admission.stats()["upstreams"].items()})
+REGISTRY.gauge_map("llm_upstream_waiting", "各上游排队中的请求数", "upstream",
+                   lambda: {k: v["waiting"] for k, v in admission.stats()["upstreams"].items()})
+
+def _http_rejection(e: AdmissionRejected) -> HTTPException:
+    return HTTPException(status_code=e.status_code, detail=str(e),
+                         headers={"Retry-After": str(e.retry_after)})
+
+# =========================
+# LLM 选路（Type=auto：在 Ollama / DeepSeek 之间按首 token 延迟选路、故障转移、对冲）
+# =========================
+LLM_ROUTER_BACKENDS = [b for b in os.getenv("LLM_ROUTER_BACKENDS", "ollama,deepseek").split(",") if b]  # 同等条件下的优先顺序
+LLM_ROUTER_WINDOW_S = float(os.getenv("LLM_ROUTER_WINDOW_S", "60"))            # 统计首 token 耗时/错误率的时间窗口
+LLM_ROUTER_MAX_ERROR_RATE = float(os.getenv("LLM_ROUTER_MAX_ERROR_RATE", "0.5"))  # 错误率超过即视为不健康
+LLM_ROUTER_MIN_SAMPLES = int(os.getenv("LLM_ROUTER_MIN_SAMPLES", "5"))          # 样本少于该数不判定为不健康
+LLM_HEDGE_AFTER_S = float(os.getenv("LLM_HEDGE_AFTER_S", "0"))                  # 主后端多久没出首 token 就发对冲请求，0 关闭
+OLLAMA_URL = os.getenv("OLLAMA_URL", os.getenv("RAG_SERVICE_URL", "http://192.168.1.254:11434/api/generate"))
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3")
+
+LLM_ROUTE_DECISIONS = REGISTRY.counter("llm_route_decisions", "选路发起的上游请求数（reason=primary/failover/hedge）")
+provider_router = ProviderRouter(LLM_ROUTER_BACKENDS,
+                                 window_s=LLM_ROUTER_WINDOW_S,
+                                 max_error_rate=LLM_ROUTER_MAX_ERROR_RATE,
+                                 min_samples=LLM_ROUTER_MIN_SAMPLES,
+                                 hedge_after_s=LLM_HEDGE_AFTER_S,
+                                 on_route=lambda b, r: LLM_ROUTE_DECISIONS.inc(backend=b, reason=r))
+REGISTRY.gauge_map("llm_route_ttft_seconds", "各后端窗口内平均首 token 耗时", "backend",
+                   lambda: {b: s["ttft_s"] or 0.0 for b, s in provider_router.stats().items()})
+REGISTRY.gauge_map("llm_route_error_rate", "各后端窗口内错误率", "backend",
+                   lambda: {b: s["error_rate"] for b, s in provider_router.stats().items()})
+REGISTRY.gauge_map("llm_route_healthy", "各后端是否健康（1/0）", "backend",
+                   lambda: {b: int(s["healthy"]) for b, s in provider_router.stats().items()})
+REGISTRY.gauge_map("llm_route_served", "最终由各后端输出的请求数", "backend",
+                   lambda: {b: s["served"] for b, s in provider_router.stats().items()})
+REGISTRY.gauge_map("llm_route_hedge_wins", "对冲请求抢到首 token 的次数", "backend",
+                   lambda: {b: s["hedge_wins"] for b, s in provider_router.stats().items()})
+
+def _router_enabled() -> bool:
+    return os.getenv("Type") == "auto"
+
+def _routed_stream(prompt: str, messages: Optional[List[Dict[str, Any]]] = None,
+                   ollama_url: Optional[str] = None, ollama_model: Optional[str] = None,
+                   **kwargs) -> RoutedStream:
+    """
+    选路流：每个后端各自经过并发槽位；Ollama 只接收 prompt，DeepSeek 使用完整 messages
+    ollama_url / ollama_model 默认 OLLAMA_URL / OLLAMA_MODEL；DeepSeek 未初始化时只走 Ollama
+    最终由哪个后端输出见 result["backend"]
+    """
+    url, model = ollama_url or OLLAMA_URL, ollama_model or OLLAMA_MODEL
+    factories = {
+        "ollama": lambda: admission.guard(
+            "ollama", OllamaStream(http_pools.get("rag"), url, model, prompt)),
+    }
+    if ds is not None:
+        factories["deepseek"] = lambda: admission.guard(
+            "deepseek", ds.stream_chat(messages or [{"role": "user", "content": prompt}], **kwargs))
+    return provider_router.stream(factories)
+
+@app.get("/llm/route_stats")
+def llm_route_stats():
+    return provider_router.stats()
+
 # =========================
 # WebSocket（对话流式）
 # =========================
+WS_MAX_INFLIGHT = int(os.getenv("WS_MAX_INFLIGHT", "4"))  # 单个连接同时处理的 request_id 上限
+WS_SEND_QUEUE_MAX = int(os.getenv("WS_SEND_QUEUE_MAX", "256"))  # 单个连接排队中的 delta 帧上限
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "coalesce")  # coalesce / drop / close
+WS_SLOW_CONSUMER_CLOSE_CODE = int(os.getenv("WS_SLOW_CONSUMER_CLOSE_CODE", "1013"))
+WS_SEND_QUEUE_MAX_CONTROL = int(os.getenv("WS_SEND_QUEUE_MAX_CONTROL", "64"))  # 排队中的 ack/result/error 帧上限，超过直接断开
+WS_RESUME_BUFFER = int(os.getenv("WS_RESUME_BUFFER", "512"))  # 每个请求保留最近多少帧供续传，0 表示关闭续传
+WS_RESUME_RETENTION_S = float(os.getenv("WS_RESUME_RETENTION_S", "60"))  # 生成结束后缓冲的保留时间
+WS_RESUME_GRACE_S = float(os.getenv("WS_RESUME_GRACE_S", "15"))  # 断线后生成继续等待重连的时间
+
+# (username, request_id) -> 生成中 / 刚生成完的流
+streams = StreamRegistry(retention_s=WS_RESUME_RETENTION_S if WS_RESUME_BUFFER > 0 else 0,
+                         grace_s=WS_RESUME_GRACE_S if WS_RESUME_BUFFER > 0 else 0)
+
+@app.on_event("shutdown")
+async def _close_streams():
+    await streams.aclose()
+
+@app.get("/ws/backpressure_stats")
+async def ws_backpressure_stats():
+    """
+    慢消费者（发送队列溢出）统计
+    """
+    return dict(BACKPRESSURE_STATS)
+
 @app.websocket("/ws")
 async def chat_ws(websocket: WebSocket):
     """
     LLM 对话流式（占位）：
     - 握手用 ?token=<JWT> 鉴权
+    - 每个 request_id 独立一个任务并发处理，单连接最多 WS_MAX_INFLIGHT 个
+    - 增量合并：?coalesce=latency|balanced|throughput（可选 coalesce_ms / coalesce_bytes 微调），
+      默认值见环境变量 WS_COALESCE_MODE / WS_COALESCE_WINDOW_MS / WS_COALESCE_MAX_BYTES；
+      coalesce_ms 须在 0..1000 之间、coalesce_bytes 为非负整数，否则握手以 1003 关闭
     - 消息格式：
       客户端 -> 服务端：
         {"action":"chat.create",
         "request_id":"req-1",
         "payload":{"messages":[{"role":"user","content":"你好"}]}}
+        {"action":"chat.cancel","request_id":"req-1"}   # 中止该请求，上游流同时关闭
+        {"action":"chat.resume","request_id":"req-1","payload":{"last_index":5}}  # 重连后续传
       服务端 -> 客户端（流）：
         {"type":"ack","request_id":"req-1"}
         {"type":"delta","request_id":"req-1","data":{"index":0,"delta":"你"}}
-        {"type":"delta","request_id":"req-1","data":{"index":0,"delta":"好"}}
-        {"type":"result","request_id":"req-1","data":{"finish_reason":"stop","usage":{...}}}
+        {"type":"delta","request_id":"req-1","data":{"index":1,"delta":"好"}}
+        {"type":"result","request_id":"req-1","data":{"finish_reason":"stop","usage":{...},"timing":{...}}}
+      usage 优先取上游返回的 token 数；timing 含 connect_ms / ttft_ms / duration_ms / tokens_per_s
+      index 为该 request_id 下 delta 帧的序号，从 0 递增；每帧可能是合并后的多个 token
+      被取消时 result 的 finish_reason 为 "cancelled"
+    - 断线续传：生成与连接解耦，每个 (用户, request_id) 保留最近 WS_RESUME_BUFFER 帧；
+      断线后生成继续 WS_RESUME_GRACE_S 秒，期间 chat.resume 先补发 index > last_index 的帧再跟随实时输出，
+      没人接回就取消上游；生成结束后缓冲再保留 WS_RESUME_RETENTION_S 秒。
+      需要的帧已被淘汰时返回 RESUME_GAP 错误
+    - 发送走有界队列（WS_SEND_QUEUE_MAX），客户端读得慢时按 WS_SLOW_CONSUMER_POLICY 合并 / 丢弃 / 断开，
+      丢弃时会收到 {"type":"dropped","request_id":..,"data":{"frames":..,"bytes":..,"last_index":..}}
     """
     token = websocket.query_params.get("token")
 
     # 验证token
+    t_auth = time.perf_counter()
     try:
         user_info = await validate_ws_token(token)
     except HTTPException as e:
@@ -169,10 +486,42 @@ async def chat_ws(websocket: WebSocket):
         await websocket.close(code=code)
 
         return
+    finally:
+        WS_AUTH_SECONDS.observe(time.perf_counter() - t_auth)
+
+    # 合并参数在握手时校验，非法直接 1003 关闭
+    try:
+        coalesce = coalesce_config_from_query(websocket.query_params)
+    except ValueError:
+        await websocket.close(code=1003)
+        return
 
     await websocket.accept()
     username = user_info.get("username", "unknown")
 
+    # 多个任务共用一个连接，统一经发送队列由单个写任务发出
+    outbox = WSOutbox(websocket,
+                      max_frames=WS_SEND_QUEUE_MAX,
+                      policy=WS_SLOW_CONSUMER_POLICY,
+                      close_code=WS_SLOW_CONSUMER_CLOSE_CODE,
+                      max_control=WS_SEND_QUEUE_MAX_CONTROL)
+    send = outbox.send
+
+    tasks: Dict[str, asyncio.Task] = {}  # request_id -> 本连接上正在转发该请求的任务
+
+    def attach(req_id: str, buffer: StreamBuffer, from_index: int) -> None:
+        """把一个流（新建的或续传的）挂到本连接上转发"""
+        entry = streams.attach((username, req_id))
+        task = asyncio.create_task(_chat_attach(send, req_id, buffer, from_index, username))
+        tasks[req_id] = task
+
+        def _done(t: asyncio.Task) -> None:
+            if tasks.get(req_id) is t:
+                tasks.pop(req_id)
+            streams.detach(entry)
+
+        task.add_done_callback(_done)
+
     try:
         while True:
             raw = await websocket.receive_text()
@@ -183,119 +532,361 @@ async def chat_ws(websocket: WebSocket):
             try:
                 # 获取message
                 msg = json.loads(raw)
-            except json.JSONDecodeError:
+                if not isinstance(msg, dict):
+                    raise ValueError("message must be a json object")
+            except ValueError:  # json.JSONDecodeError 是 ValueError 的子类
                 # 捕获json解析错误
-                await websocket.send_text(json.dumps(
+                await send(
                     {"type": "error",
                      "error": {"code": "BAD_REQUEST",
                                "message": "invalid json"}
-                     }))
+                     })
                 continue
 
             action = msg.get("action")          # 用于分支功能
             req_id = msg.get("request_id", "")  # request_id为对话id
             payload = msg.get("payload", {})    # 请求的"有效载荷"，真正装业务数据的部分
 
+            if action in ("chat.create", "chat.resume"):
+                if req_id in tasks:
+                    await send(_ws_error(req_id, "DUPLICATE_REQUEST", "request_id already in progress"))
+                    continue
+                if len(tasks) >= WS_MAX_INFLIGHT:
+                    await send(_ws_error(req_id, "TOO_MANY_REQUESTS",
+                                         f"at most {WS_MAX_INFLIGHT} concurrent requests per connection"))
+                    continue
+
             if action == "chat.create":
-                await websocket.send_text(json.dumps({"type": "ack", "request_id": req_id}))
-
-                # 取首条 user 消息
-                text = ""
-                for m in payload.get("messages", None):
-                    if m.get("role") == "user":
-                        # 这里还没有实现记录历史，之后增加
-                        text = m.get("content", "")
-                        break
-
-                # 检查是否是RAG查询请求
-                is_rag_query = "rag" in text.lower() or "查询" in text.lower() or "诈骗" in text.lower()
-                
-                if is_rag_query and os.getenv("USE_EXTERNAL_RAG", "false").lower() == "true":
-                    # 使用外部 RAG 服务
-                    RAG_SERVICE_URL = os.getenv("RAG_SERVICE_URL", "http://192.168.1.254:11434/api/generate")
-                    rag_payload = {
-                        "model": "llama3",
-                        "prompt": text,
-                        "stream": True
-                    }
-                    
-                    try:
-                        async with httpx.AsyncClient(timeout=30.0) as client:
-                            async with client.stream("POST", RAG_SERVICE_URL, json=rag_payload) as response:
-                                if response.status_code == 200:
-                                    text_total = ""
-                                    async for line in response.aiter_lines():
-                                        if line:
-                                            try:
-                                                data = json.loads(line)
-                                                if "response" in data:
-                                                    delta = data["response"]
-                                                    text_total += delta
-                                                    await websocket.send_text(json.dumps({
-                                                        "type": "delta",
-                                                        "request_id": req_id,
-                                                        "data": {"index": 0, "delta": delta}}))
-                                                    await asyncio.sleep(0)
-                                            except json.JSONDecodeError:
-                                                continue
-                                else:
-                                    # 如果外部服务出错，使用默认回复
-                                    error_msg = "抱歉，暂时无法查询相关信息。"
-                                    for delta in error_msg:
-                                        await websocket.send_text(json.dumps({
-                                            "type": "delta",
-                                            "request_id": req_id,
-                                            "data": {"index": 0, "delta": delta}}))
-                                        await asyncio.sleep(0)
-                    except Exception as e:
-                        # 如果外部服务不可用，使用默认回复
-                        error_msg = "抱歉，查询服务暂时不可用。"
-                        for delta in error_msg:
-                            await websocket.send_text(json.dumps({
-                                "type": "delta",
-                                "request_id": req_id,
-                                "data": {"index": 0, "delta": delta}}))
-                            await asyncio.sleep(0)
-                elif os.getenv("Type")=="ollama":
-                    text_total = ""
-                    for delta in "ollama功能还未实装---------请期待":
-                        text_total = text_total + delta
-                        await websocket.send_text(json.dumps({
-                            "type": "delta",
-                            "request_id": req_id,
-                            "data": {"index": 0, "delta": delta}}))
-
-                # 发送结束字段
-                await websocket.send_text(json.dumps({
-                    "type": "result",
-                    "request_id": req_id,
-                    "data": {
-                        "finish_reason": "stop",
-                        "usage": {
-                            "prompt_tokens": 0,
-                            "completion_tokens": len(text),
-                            "total_tokens": len(text)
-                        }
-                    },
-                    "meta": {"processed_by": f"ws:{username}"}
-                }))
+                key = (username, req_id)
+                if streams.running(key):
+                    await send(_ws_error(req_id, "DUPLICATE_REQUEST", "request_id already in progress, use chat.resume"))
+                    continue
+                messages = payload.get("messages") if isinstance(payload, dict) else None
+                if not isinstance(messages, list) or not all(isinstance(m, dict) for m in messages):
+                    await send(_ws_error(req_id, "BAD_REQUEST", "payload.messages must be a list of objects"))
+                    continue
+                try:
+                    admission.check_user(username)
+                except AdmissionRejected as e:
+                    await send(_ws_error(req_id, e.code, str(e), retry_after=e.retry_after))
+                    continue
+                await send({"type": "ack", "request_id": req_id})
+                buffer = StreamBuffer(maxlen=max(WS_RESUME_BUFFER, WS_SEND_QUEUE_MAX))
+                streams.start(key, buffer, _chat_produce(buffer, payload, coalesce))
+                attach(req_id, buffer, 0)
+            elif action == "chat.resume":
+                buffer = streams.get((username, req_id))
+                if buffer is None:
+                    await send(_ws_error(req_id, "NOT_FOUND", "no such request to resume"))
+                    continue
+                last_index = payload.get("last_index", -1) if isinstance(payload, dict) else None
+                if not isinstance(last_index, int) or isinstance(last_index, bool) or last_index < -1:
+                    await send(_ws_error(req_id, "BAD_REQUEST", "last_index must be an integer >= -1"))
+                    continue
+                from_index = last_index + 1
+                await send({"type": "ack", "request_id": req_id, "data": {"resume_from": from_index}})
+                attach(req_id, buffer, from_index)
+            elif action == "chat.cancel":
+                if not streams.cancel((username, req_id)):
+                    await send(_ws_error(req_id, "NOT_FOUND", "no such request in progress"))
+                # 生成任务结束后会发送 finish_reason=cancelled 的 result
             else:
-                await websocket.send_text(json.dumps({
-                    "type": "error",
-                    "request_id": req_id,
-                    "error": {"code": "BAD_REQUEST", "message": "unknown action"}
-                }))
+                await send(_ws_error(req_id, "BAD_REQUEST", "unknown action"))
     except WebSocketDisconnect:
         # 客户端断开
         print("\n=== 客户端断开 ===\n")
+    except SlowConsumerError:
+        # 客户端不读响应，控制帧堆积超限，连接已被关闭
         pass
+    finally:
+        # 停止向本连接转发；没人接回的生成任务在宽限期后取消，不再占用上游 LLM
+        pending = list(tasks.values())
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        await outbox.aclose()
+
+
+def _ws_error(req_id: str, code: str, message: str, **extra: Any) -> Dict[str, Any]:
+    return {"type": "error", "request_id": req_id, "error": {"code": code, "message": message, **extra}}
+
+
+async def _chat_produce(buffer: StreamBuffer, payload: Dict[str, Any], coalesce) -> None:
+    """
+    生成任务：调用上游，把（合并后的）增量写进 buffer，与具体连接无关
+    被 chat.cancel 或宽限期到期取消时，关闭上游流并以 finish_reason=cancelled 结束
+    """
+    result: Dict[str, Any] = {}  # 上游结束时填入 finish_reason / usage
+    timer = StreamTimer()
+    try:
+        # 取首条 user 消息；放在 try 里，payload 格式异常时同样以 error 结束 buffer，订阅方不会一直等
+        text = ""
+        for m in payload.get("messages") or []:
+            if m.get("role") == "user":
+                # 这里还没有实现记录历史，之后增加
+                text = m.get("content", "")
+                break
+
+        source = timer.wrap(_chat_deltas(text, payload, result, timer))
+        async for delta in coalesce_deltas(source, coalesce):
+            buffer.publish(delta)
+    except asyncio.CancelledError:
+        buffer.close({"finish_reason": "cancelled", "usage": _usage(result, timer), "timing": timer.finish()})
+        raise
+    except Exception as e:
+        print(f"[ws] generation failed: {e}")
+        buffer.close(error=e)
+        return
+
+    usage = _usage(result, timer)
+    buffer.close({
+        "finish_reason": result.get("finish_reason") or "stop",
+        "usage": usage,
+        "timing": timer.finish(usage["completion_tokens"]),
+    })
+
+
+async def _chat_attach(send, req_id: str, buffer: StreamBuffer, from_index: int, username: str) -> None:
+    """
+    转发任务：从 from_index 起把 buffer 里的增量发给本连接（先补发，再跟随实时），最后发送 result
+    close 策略下发送队列溢出时连接已被关闭，安静退出（生成任务按宽限期处理）
+    """
+    try:
+        await _chat_forward(send, req_id, buffer, from_index, username)
+    except SlowConsumerError:
+        return
+
+
+async def _chat_forward(send, req_id: str, buffer: StreamBuffer, from_index: int, username: str) -> None:
+    try:
+        async for index, delta in buffer.subscribe(from_index):
+            await send({
+                "type": "delta",
+                "request_id": req_id,
+                "data": {"index": index, "delta": delta}})
+    except ResumeGap as e:
+        await send(_ws_error(req_id, "RESUME_GAP", f"frames before index {e.first_index} are no longer available"))
+        return
+
+    if isinstance(buffer.error, AdmissionRejected):
+        await send(_ws_error(req_id, buffer.error.code, str(buffer.error), retry_after=buffer.error.retry_after))
+        return
+    if buffer.error is not None:
+        await send(_ws_error(req_id, "INTERNAL_ERROR", "request failed"))
+        return
+
+    # 发送结束字段
+    await send({
+        "type": "result",
+        "request_id": req_id,
+        "data": buffer.result,
+        "meta": {"processed_by": f"ws:{username}"}
+    })
+
+
+def _usage(result: Dict[str, Any], timer: StreamTimer) -> Dict[str, int]:
+    """
+    优先用上游返回的 usage；上游没给时 completion_tokens 取实际收到的增量数
+    """
+    upstream = result.get("usage") or {}
+    prompt_tokens = int(upstream.get("prompt_tokens") or 0)
+    completion_tokens = upstream.get("completion_tokens")
+    completion_tokens = int(completion_tokens) if completion_tokens is not None else timer.tokens
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+async def _chat_deltas(text: str, payload: Dict[str, Any], result: Dict[str, Any], timer: StreamTimer):
+    """
+    按配置选择后端，逐个产出文本增量；上游给出的 finish_reason / usage 写入 result，建连耗时写入 timer
+    """
+    # 检查是否是RAG查询请求
+    is_rag_query = "rag" in text.lower() or "查询" in text.lower() or "诈骗" in text.lower()
+
+    if is_rag_query and os.getenv("USE_EXTERNAL_RAG", "false").lower() == "true":
+        # 使用外部 RAG 服务
+        RAG_SERVICE_URL = os.getenv("RAG_SERVICE_URL", "http://192.168.1.254:11434/api/generate")
+        stream = _rag_stream(RAG_SERVICE_URL, "llama3", text)
+        try:
+            async for delta in stream:
+                yield delta
+            result.update(stream.result)
+        except AdmissionRejected:
+            raise
+        except UpstreamError:
+            # 如果外部服务出错，使用默认回复
+            yield "抱歉，暂时无法查询相关信息。"
+        except Exception:
+            # 如果外部服务不可用，使用默认回复
+            yield "抱歉，查询服务暂时不可用。"
+        finally:
+            timer.connect_s = stream.connect_s
+    elif _router_enabled() or (os.getenv("Type") == "deepseek" and ds is not None):
+        try:
+            body = ChatCreatePayload(**payload)
+        except Exception:
+            yield "请求格式错误：messages 不合法。"
+            return
+        messages = [m.model_dump() for m in body.messages]
+        if _router_enabled():
+            stream = _routed_stream(text, messages, temperature=body.temperature, max_tokens=body.max_tokens)
+        else:
+            stream = admission.guard("deepseek", ds.stream_chat(messages,
+                                                                temperature=body.temperature,
+                                                                max_tokens=body.max_tokens))
+        try:
+            async for delta in stream:
+                yield delta
+            result.update(stream.result)
+        finally:
+            timer.connect_s = stream.connect_s
+    elif os.getenv("Type")=="ollama":
+        yield "ollama功能还未实装---------请期待"
 
 # =========================
 # 语音克隆检查
 # =========================
 
+ANTI_SPOOF_WORKERS = int(os.getenv("ANTI_SPOOF_WORKERS", "4"))      # 推理线程数（解码/预处理并行，模型 forward 由微批线程统一执行）
+ANTI_SPOOF_MAX_QUEUE = int(os.getenv("ANTI_SPOOF_MAX_QUEUE", "8"))   # 推理排队上限，超过直接 503
+ANTI_SPOOF_BATCH_SIZE = int(os.getenv("ANTI_SPOOF_BATCH_SIZE", "8"))  # 微批最大条数，1 表示关闭微批
+ANTI_SPOOF_BATCH_WAIT_MS = float(os.getenv("ANTI_SPOOF_BATCH_WAIT_MS", "5"))  # 凑批最多等待时间
+ANTI_SPOOF_VAD = os.getenv("ANTI_SPOOF_VAD", "0") == "1"                 # 人声检测（能量 + 过零率，向量化），默认关闭
+ANTI_SPOOF_VAD_TRIM = os.getenv("ANTI_SPOOF_VAD_TRIM", "0") == "1"       # 只把人声区间送进模型（需 ANTI_SPOOF_VAD=1）
+ANTI_SPOOF_MIN_SPEECH_RATIO = float(os.getenv("ANTI_SPOOF_MIN_SPEECH_RATIO", "0.3"))  # 人声占比低于此值判为无效
+ANTI_SPOOF_SEGMENTED = os.getenv("ANTI_SPOOF_SEGMENTED", "0") == "1"     # 长音频按 nb_samp 分窗评分（默认关闭：开启后分数分布会变，阈值需重新标定）
+ANTI_SPOOF_SEGMENT_HOP = int(os.getenv("ANTI_SPOOF_SEGMENT_HOP", "0"))     # 窗口步长（采样点），0 表示等于 nb_samp
+ANTI_SPOOF_SEGMENT_BATCH = int(os.getenv("ANTI_SPOOF_SEGMENT_BATCH", "8"))  # 每次一起推理的窗口数
+ANTI_SPOOF_AGGREGATE = os.getenv("ANTI_SPOOF_AGGREGATE", "mean")           # 窗口概率汇总：mean / max / quantile
+ANTI_SPOOF_AGG_QUANTILE = float(os.getenv("ANTI_SPOOF_AGG_QUANTILE", "0.9"))
+ANTI_SPOOF_EARLY_EXIT = int(os.getenv("ANTI_SPOOF_EARLY_EXIT", "0"))       # 这么多窗口结论一致就提前结束，0 关闭
+ANTI_SPOOF_RESAMPLE_FAST = os.getenv("ANTI_SPOOF_RESAMPLE_FAST", "0") == "1"  # 重采样用更短的 sinc 核（更快，精度略低）
+ANTI_SPOOF_BACKEND = os.getenv("ANTI_SPOOF_BACKEND", "torch")            # torch / onnx / torchscript（后两者需 ANTI_SPOOF_SEGMENTED=1）
+ANTI_SPOOF_ARTIFACT = os.getenv("ANTI_SPOOF_ARTIFACT")                      # onnx / torchscript 时导出文件路径（module.anti_spoof.export 生成）
+ANTI_SPOOF_ORT_THREADS = int(os.getenv("ANTI_SPOOF_ORT_THREADS", "0"))     # ONNX Runtime 线程数，0 用默认
+ANTI_SPOOF_WS_HOP = int(os.getenv("ANTI_SPOOF_WS_HOP", "0"))            # 实时流窗口步长（16k 采样点），0 表示等于 nb_samp
+ANTI_SPOOF_WS_MIN_HOP = int(os.getenv("ANTI_SPOOF_WS_MIN_HOP", "0"))    # 客户端可设的最小步长，0 表示 nb_samp // 4；步长越小每帧要推理的窗口越多
+ANTI_SPOOF_WS_MAX_FRAME_BYTES = int(os.getenv("ANTI_SPOOF_WS_MAX_FRAME_BYTES", str(256 * 1024)))  # 实时流单帧上限
+ANTI_SPOOF_WS_SAMPLE_RATES = {int(r) for r in os.getenv("ANTI_SPOOF_WS_SAMPLE_RATES", "8000,16000,44100,48000").split(",") if r}  # 实时流允许的采样率
+ANTI_SPOOF_WS_MAX_CHANNELS = int(os.getenv("ANTI_SPOOF_WS_MAX_CHANNELS", "2"))  # 实时流最多声道数
+ANTI_SPOOF_MAX_UPLOAD_BYTES = int(os.getenv("ANTI_SPOOF_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))  # 上传音频大小上限，超过 413
+
+anti_spoof_executor = BoundedExecutor(max_workers=ANTI_SPOOF_WORKERS,
+                                      max_queue=ANTI_SPOOF_MAX_QUEUE,
+                                      name="anti_spoof",
+                                      on_wait=ANTI_SPOOF_QUEUE_WAIT_SECONDS.observe,
+                                      on_run=ANTI_SPOOF_INFER_SECONDS.observe)
+REGISTRY.gauge_map("anti_spoof_executor", "反欺诈推理线程池状态", "state",
+                   lambda: {k: v for k, v in anti_spoof_executor.stats().items() if k in ("active", "waiting")})
+REGISTRY.gauge_fn("anti_spoof_rejected", "推理队列已满被拒绝的请求数", lambda: anti_spoof_executor.rejected)
+
+REGISTRY.gauge_map("anti_spoof_batches", "AASIST 微批次数/条数", "kind",
+                   lambda: {k: v for k, v in detector.batcher.stats().items() if k in ("batches", "items")}
+                   if detector is not None and detector.batcher is not None else {})
+
+@app.on_event("shutdown")
+def _close_anti_spoof_executor():
+    anti_spoof_executor.shutdown()
+    if detector is not None:
+        detector.close()
+
+@app.get("/anti_spoof/executor_stats")
+def anti_spoof_executor_stats():
+    stats = anti_spoof_executor.stats()
+    if detector is not None and detector.batcher is not None:
+        stats["batching"] = detector.batcher.stats()
+    return stats
+
+async def _read_multipart_file(request: Request, name: str, limit: int, overhead: int = 64 * 1024) -> bytearray:
+    """
+    边收边解析 multipart/form-data 请求体，只把字段 name 的内容追加进一个 bytearray（不落临时文件、不整体缓存请求体）：
+    - Content-Length 超过 limit + overhead 时一个字节都不读就 413，非法时 400
+    - 没有长度（chunked）时边读边计数，请求体或文件内容超限立即 413，不再继续读
+    """
+    body_limit = limit + overhead  # 留给 multipart 边界、头部和其它字段
+    length = request.headers.get("content-length")
+    if length is not None:
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise HTTPException(status_code=400, detail="Content-Length 非法")
+        if length > body_limit:
+            raise HTTPException(status_code=413, detail=f"请求体超过 {body_limit} 字节")
+
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="需要 multipart/form-data 上传")
+
+    out = bytearray()
+    found = False
+    target = False
+    header_field, header_value, part_name = b"", b"", None
+
+    def on_part_begin():
+        nonlocal part_name
+        part_name = None
+
+    def on_header_field(data, start, end):
+        nonlocal header_field
+        header_field += data[start:end]
+
+    def on_header_value(data, start, end):
+        nonlocal header_value
+        header_value += data[start:end]
+
+    def on_header_end():
+        nonlocal header_field, header_value, part_name
+        if header_field.lower() == b"content-disposition":
+            part_name = parse_options_header(header_value)[1].get(b"name")
+        header_field, header_value = b"", b""
+
+    def on_headers_finished():
+        nonlocal target
+        target = not found and part_name == name.encode()
+
+    def on_part_data(data, start, end):
+        if target:
+            out.extend(data[start:end])
+            if len(out) > limit:
+                raise HTTPException(status_code=413, detail=f"音频文件超过 {limit} 字节")
+
+    def on_part_end():
+        nonlocal found, target
+        found = found or target
+        target = False
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    received = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > body_limit:
+                raise HTTPException(status_code=413, detail=f"请求体超过 {body_limit} 字节")
+            parser.write(chunk)
+        parser.finalize()
+    except MultipartParseError:
+        raise HTTPException(status_code=400, detail="multipart 请求体格式错误")
+    if not found:
+        raise HTTPException(status_code=400, detail=f"缺少表单字段 {name}")
+    return out
+
 @app.post("/anti_spoof_score")
-async def score(file: UploadFile = File(...)):
+async def score(request: Request):
     """
     spoof_prob：伪造概率（越大越像伪造/合成音频）
     label：
@@ -303,123 +894,438 @@ async def score(file: UploadFile = File(...)):
         "spoof" = 伪造/深度合成音频
     valid：是否通过前置校验（最小时长、VAD）；False 时给出 reason（比如 too_short_or_no_speech）
     meta：一些有用的附加信息（时长、语音占比），便于后续监控与调参
+    请求为 multipart/form-data，音频在字段 file 中；请求体超过上限时 413，且在解析表单之前就拒绝
+    推理在专用线程池中执行，不阻塞事件循环；排队已满时返回 503
     """
     if detector is None:
         raise HTTPException(status_code=503, detail="detector 未实例化")
     # 阈值
     THRESHOLD = 0.5
 
-    # 将文件本地缓存
-    raw = await file.read()
-    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp:
-        tmp.write(raw)
-        tmp_path = tmp.name
+    # 边收边解析，只保留音频字段本身，超限立即 413，不落临时文件
+    raw = await _read_multipart_file(request, "file", ANTI_SPOOF_MAX_UPLOAD_BYTES)
     try:
-        # 调用库处理文件
-        prob, meta = detector.score_wav(tmp_path)  # 你的类里会统一到 16k/mono 并推理
-
-        # 如果文件预处理不通过，就直接返回固定格式
-        valid = not meta.get("reason")
-        if not valid:
-            return {
-                "spoof_prob": -1.0,
-                "label": "invalid",
-                "valid": False,
-                "reason": meta.get("reason", ""),
-                "meta": {k: v for k, v in meta.items() if k in ("duration","speech_ratio")},
-            }
-
-        # 返回模型输出
-        label = "spoof" if (prob is not None and float(prob) >= THRESHOLD) else "genuine"
+        # 调用库处理文件（你的类里会统一到 16k/mono 并推理）
+        prob, meta = await anti_spoof_executor.run(detector.score_wav, raw)
+    except ExecutorSaturated as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    # 如果文件预处理不通过，就直接返回固定格式
+    valid = not meta.get("reason")
+    if not valid:
         return {
-            "spoof_prob": float(prob) if prob is not None else -1.0,
-            "label": label,
-            "valid": True,
-            "reason": "",
-            "meta": {k: v for k, v in meta.items() if k in ("duration","speech_ratio")},
+            "spoof_prob": -1.0,
+            "label": "invalid",
+            "valid": False,
+            "reason": meta.get("reason", ""),
+            "meta": {k: v for k, v in meta.items() if k in ("duration","speech_ratio","windows","windows_scored")},
         }
-    # 删除缓存文件
-    finally:
-        try: os.remove(tmp_path)
-        except: pass
+
+    # 返回模型输出
+    label = "spoof" if (prob is not None and float(prob) >= THRESHOLD) else "genuine"
+    return {
+        "spoof_prob": float(prob) if prob is not None else -1.0,
+        "label": label,
+        "valid": True,
+        "reason": "",
+        "meta": {k: v for k, v in meta.items() if k in ("duration","speech_ratio","windows","windows_scored")},
+    }
+
+@app.websocket("/ws/anti_spoof")
+async def anti_spoof_ws(websocket: WebSocket):
+    """
+    实时语音克隆检测（通话过程中持续给出伪造概率）：
+    - 握手：?token=<JWT>&sample_rate=16000&channels=1&format=s16le|f32le
+      可选 hop=<16k 采样点数>，默认等于窗口长度 nb_samp（不重叠）
+      sample_rate 只接受 ANTI_SPOOF_WS_SAMPLE_RATES，channels 为 1..ANTI_SPOOF_WS_MAX_CHANNELS，
+      hop 不小于 ANTI_SPOOF_WS_MIN_HOP（默认 nb_samp // 4）；参数非法时以 1003 关闭
+    - 客户端 -> 服务端：二进制帧为原始 PCM（小端、交织），单帧不超过 ANTI_SPOOF_WS_MAX_FRAME_BYTES；
+      文本帧 {"action":"end"} 表示音频结束
+    - 服务端 -> 客户端：
+        {"type":"ready","data":{"sample_rate":16000,"window":64600,"hop":64600}}
+        {"type":"score","data":{"index":0,"start_s":0.0,"end_s":4.04,"spoof_prob":0.12,"label":"genuine"}}
+        {"type":"error","error":{"code":"OVERLOADED","message":..,"index":3}}   # 推理繁忙，该窗口跳过
+        {"type":"error","error":{"code":"OVERLOADED","message":..}}             # 重采样繁忙，该片段丢弃（无 index）
+        {"type":"end","data":{"windows":12,"mean_prob":..,"max_prob":..}}
+    每个连接只保留一个窗口的滚动缓冲和汇总值，内存不随通话时长增长
+    """
+    token = websocket.query_params.get("token")
+    try:
+        await validate_ws_token(token)
+    except HTTPException as e:
+        await websocket.close(code=1008 if e.status_code == 401 else 1011)
+        return
+    if detector is None:
+        await websocket.close(code=1011)
+        return
+
+    params = websocket.query_params
+    try:
+        hop = int(params.get("hop") or ANTI_SPOOF_WS_HOP) or None
+        sample_rate = int(params.get("sample_rate", "16000"))
+        channels = int(params.get("channels", "1"))
+        # 任意采样率会构建（并缓存）很大的重采样核，只放行常见采样率
+        if sample_rate not in ANTI_SPOOF_WS_SAMPLE_RATES:
+            raise ValueError(f"unsupported sample_rate: {sample_rate}")
+        if not 1 <= channels <= ANTI_SPOOF_WS_MAX_CHANNELS:
+            raise ValueError(f"unsupported channels: {channels}")
+        min_hop = ANTI_SPOOF_WS_MIN_HOP or detector.nb_samp // 4
+        if hop is not None and hop < min_hop:
+            raise ValueError(f"hop must be >= {min_hop}: {hop}")
+        windower = StreamingWindower(detector.nb_samp,
+                                     hop=hop,
+                                     sample_rate=sample_rate,
+                                     channels=channels,
+                                     fmt=params.get("format", "s16le"),
+                                     resample=detector.resample_to_16k)
+    except ValueError:
+        await websocket.close(code=1003)
+        return
+
+    await websocket.accept()
+    await websocket.send_json({"type": "ready",
+                               "data": {"sample_rate": 16000, "window": windower.win, "hop": windower.hop}})
+    scored, total, max_prob = 0, 0.0, 0.0
+    try:
+        while True:
+            msg = await websocket.receive()
+            if msg["type"] == "websocket.disconnect":
+                break
+            data = msg.get("bytes")
+            if data is None:
+                try:
+                    action = json.loads(msg.get("text") or "{}").get("action")
+                except (json.JSONDecodeError, AttributeError):
+                    action = None
+                if action == "end":
+                    await websocket.send_json({"type": "end", "data": {
+                        "windows": scored,
+                        "mean_prob": (total / scored) if scored else None,
+                        "max_prob": max_prob if scored else None}})
+                    await websocket.close()
+                    break
+                await websocket.send_json({"type": "error",
+                                           "error": {"code": "BAD_REQUEST", "message": "unknown action"}})
+                continue
+            if len(data) > ANTI_SPOOF_WS_MAX_FRAME_BYTES:
+                await websocket.close(code=1009)
+                break
+
+            # 16k 直接在事件循环里解码；需要重采样时放到推理线程池，线程池已满时该片段丢弃
+            if windower.needs_resample:
+                try:
+                    await anti_spoof_executor.run(windower.push, data)
+                except ExecutorSaturated as e:
+                    await websocket.send_json({"type": "error", "error": {
+                        "code": "OVERLOADED", "message": str(e), "retry_after": e.retry_after}})
+                    continue
+            else:
+                windower.push(data)
+            # 窗口逐个取出、逐个推理，同一时刻只有一个窗口副本
+            while True:
+                item = windower.next_window()
+                if item is None:
+                    break
+                index, start_s, window = item
+                try:
+                    prob = await anti_spoof_executor.run(detector.score_window, window)
+                except ExecutorSaturated as e:
+                    await websocket.send_json({"type": "error", "error": {
+                        "code": "OVERLOADED", "message": str(e), "index": index, "retry_after": e.retry_after}})
+                    continue
+                scored += 1
+                total += prob
+                max_prob = max(max_prob, prob)
+                await websocket.send_json({"type": "score", "data": {
+                    "index": index,
+                    "start_s": start_s,
+                    "end_s": start_s + windower.win / 16000.0,
+                    "spoof_prob": prob,
+                    "label": "spoof" if prob >= detector.threshold else "genuine"}})
+    except WebSocketDisconnect:
+        pass
 
 # =========================
 # RAG服务调用接口
 # =========================
-@app.post("/rag/external_query")
-async def rag_external_query(request: RAGService, user_info: Dict[str, Any] = Depends(bearer_auth)):
+RAG_CACHE_MAX_SIZE = int(os.getenv("RAG_CACHE_MAX_SIZE", "1000"))  # 答案缓存条数上限
+RAG_CACHE_TTL_S = float(os.getenv("RAG_CACHE_TTL_S", "3600"))      # 答案缓存有效期，0 表示关闭
+RAG_CACHE_PATH = os.getenv("RAG_CACHE_PATH")                        # 配置后启动时加载、退出时保存
+RAG_CACHE_REPLAY_CHARS = int(os.getenv("RAG_CACHE_REPLAY_CHARS", "16"))  # 流式回放时每段的字数
+ADMIN_USERS = {u for u in os.getenv("ADMIN_USERS", "").split(",") if u}
+LLM_SINGLEFLIGHT = os.getenv("LLM_SINGLEFLIGHT", "1") == "1"  # 相同问题的并发流式请求共用一次上游生成
+RAG_SSE_HEARTBEAT_S = float(os.getenv("RAG_SSE_HEARTBEAT_S", "15"))  # SSE 空闲多久发一次心跳注释，0 关闭
+RAG_BATCH_RATE_PER_MIN = float(os.getenv("RAG_BATCH_RATE_PER_MIN", "600"))  # 批量接口每个用户每分钟条数（独立于 LLM_USER_RATE_PER_MIN），0 表示不限
+RAG_BATCH_BURST = int(os.getenv("RAG_BATCH_BURST", "200"))          # 批量接口令牌桶容量
+RAG_BATCH_TOKEN_WAIT_S = float(os.getenv("RAG_BATCH_TOKEN_WAIT_S", "60"))  # 单条等待令牌的最长时间，超过返回 429
+RAG_BATCH_MAX_ITEMS = int(os.getenv("RAG_BATCH_MAX_ITEMS", str(RAG_BATCH_BURST)))  # 批量接口单次最多条数，默认与令牌桶容量一致
+RAG_BATCH_CONCURRENCY = int(os.getenv("RAG_BATCH_CONCURRENCY", "8"))  # 批量接口单次请求的并发上限
+
+# 批量接口单独的令牌桶：后台任务一次几百条，不占也不受交互请求的限流额度影响
+batch_admission = Admission(rate_per_min=RAG_BATCH_RATE_PER_MIN, burst=RAG_BATCH_BURST)
+
+rag_cache = AnswerCache(max_size=RAG_CACHE_MAX_SIZE, ttl_s=RAG_CACHE_TTL_S, path=RAG_CACHE_PATH)
+REGISTRY.gauge_map("rag_cache_lookups", "RAG 答案缓存命中/未命中次数", "result",
+                   lambda: {"hit": rag_cache.hits, "miss": rag_cache.misses})
+
+SINGLEFLIGHT_JOINS = REGISTRY.counter("llm_singleflight_joins", "流式请求加入上游生成的次数（leader=发起，follower=复用）")
+singleflight = SingleFlight(
+    on_join=lambda leader: SINGLEFLIGHT_JOINS.inc(role="leader" if leader else "follower"))
+REGISTRY.gauge_fn("llm_singleflight_inflight", "正在进行的共享上游生成数", singleflight.inflight)
+
+def _rag_stream(url: str, model: str, prompt: str) -> CachingStream:
     """
-    调用外部 RAG 服务进行查询
+    RAG 流式上游：答案缓存 -> 单飞合并 -> 并发槽位 -> Ollama（Type=auto 时改为选路流）
+    缓存命中直接回放；未命中时相同 (归一化问题, 模型) 的并发请求共用一次生成，只有真正访问上游的那一次占槽位
+    选路故障转移到 DeepSeek 时答案没有 RAG 上下文，不写入缓存
     """
-    RAG_SERVICE_URL = os.getenv("RAG_SERVICE_URL", "http://localhost:11434/api/generate")
+    def upstream():
+        if _router_enabled():
+            return _routed_stream(prompt, ollama_url=url, ollama_model=model)
+        return admission.guard("ollama", OllamaStream(http_pools.get("rag"), url, model, prompt))
+
+    factory = upstream
+    if LLM_SINGLEFLIGHT:
+        key = (model, normalize_query(prompt))
+        factory = lambda: singleflight.stream(key, upstream)
+    return CachingStream(rag_cache, prompt, model, factory, RAG_CACHE_REPLAY_CHARS,
+                         cacheable=lambda result: result.get("backend", "ollama") == "ollama")
+
+@app.on_event("startup")
+def _load_rag_cache():
+    try:
+        n = rag_cache.load()
+        if n:
+            print(f"[startup] RAG 答案缓存已加载 {n} 条")
+    except Exception as e:
+        print(f"[startup] RAG cache load failed: {e}")
+
+@app.on_event("shutdown")
+def _save_rag_cache():
+    try:
+        rag_cache.save()
+    except Exception as e:
+        print(f"[shutdown] RAG cache save failed: {e}")
+
+def require_admin(user_info: Dict[str, Any] = Depends(bearer_auth)) -> Dict[str, Any]:
+    """
+    管理接口鉴权：roles 里带 admin / ROLE_ADMIN，或用户名在 ADMIN_USERS 里
+    """
+    roles = user_info.get("roles") or []
+    if isinstance(roles, str):
+        roles = [roles]
+    if user_info.get("username") in ADMIN_USERS or {"admin", "ROLE_ADMIN"} & set(roles):
+        return user_info
+    raise HTTPException(status_code=403, detail="Admin only")
+
+class RAGCacheInvalidate(BaseModel):
+    model_choice: Optional[str] = None  # 为空时清空全部
+
+@app.post("/admin/rag_cache/invalidate")
+async def rag_cache_invalidate(request: RAGCacheInvalidate, user_info: Dict[str, Any] = Depends(require_admin)):
+    """
+    知识图谱更新后清空 RAG 答案缓存
+    """
+    removed = rag_cache.invalidate(request.model_choice)
+    return {"removed": removed, "stats": rag_cache.stats()}
+
+@app.get("/rag/cache_stats")
+async def rag_cache_stats():
+    return rag_cache.stats()
+
+async def _rag_answer(url: str, query: str, model: str, username: str, batch: bool = False) -> "tuple[str, bool]":
+    """
+    非流式 RAG 查询：先查答案缓存（只查一次），未命中才消耗该用户一个限流令牌，再占一个 ollama 槽位调用上游
+    batch=True 时令牌从批量接口的令牌桶里取，没有令牌时最多等 RAG_BATCH_TOKEN_WAIT_S 秒
+    :return: (answer, 是否来自缓存)；失败时抛 HTTPException
+    """
+    cached = rag_cache.get(query, model)
+    if cached is not None:
+        return cached, True
+
+    try:
+        if batch:
+            await batch_admission.acquire_user(username, RAG_BATCH_TOKEN_WAIT_S)
+        else:
+            admission.check_user(username)
+    except AdmissionRejected as e:
+        raise _http_rejection(e)
 
     try:
         # 构建发送给外部 RAG 服务的请求
         rag_payload = {
-            "model": request.model_choice,
-            "prompt": request.query,
+            "model": model,
+            "prompt": query,
             "stream": False
         }
 
-        # 调用外部 RAG 服务
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(RAG_SERVICE_URL, json=rag_payload)
+        # 调用外部 RAG 服务（占用一个 ollama 并发槽位）
+        async with admission.slot("ollama"):
+            response = await http_pools.get("rag").post(url, json=rag_payload)
 
         if response.status_code == 200:
             rag_result = response.json()
-            return {
-                "query": request.query,
-                "answer": rag_result.get("response", ""),
-                "meta": {"processed_by": f"external_rag:{user_info.get('username', 'unknown')}"}
-            }
+            answer = rag_result.get("response", "")
+            rag_cache.put(query, model, answer)
+            return answer, False
         else:
             raise HTTPException(status_code=502, detail=f"External RAG service error: {response.status_code}")
 
+    except HTTPException:
+        raise
+    except AdmissionRejected as e:
+        raise _http_rejection(e)
     except httpx.RequestError as e:
         raise HTTPException(status_code=503, detail=f"Cannot connect to external RAG service: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"External RAG query failed: {str(e)}")
 
 
+@app.post("/rag/external_query")
+async def rag_external_query(request: RAGService, user_info: Dict[str, Any] = Depends(bearer_auth)):
+    """
+    调用外部 RAG 服务进行查询
+    """
+    RAG_SERVICE_URL = os.getenv("RAG_SERVICE_URL", "http://localhost:11434/api/generate")
+    username = user_info.get('username', 'unknown')
+
+    # 缓存命中不消耗限流令牌
+    answer, cached = await _rag_answer(RAG_SERVICE_URL, request.query, request.model_choice, username)
+    return {
+        "query": request.query,
+        "answer": answer,
+        "meta": {"processed_by": f"external_rag:{username}", "cached": cached}
+    }
+
+
+class RAGBatchRequest(BaseModel):
+    items: List[RAGService]
+    stream: bool = False                # True 时按完成顺序以 NDJSON 逐条返回
+    concurrency: Optional[int] = None   # 不超过 RAG_BATCH_CONCURRENCY
+
+@app.post("/rag/external_query_batch")
+async def rag_external_query_batch(request: RAGBatchRequest, user_info: Dict[str, Any] = Depends(bearer_auth)):
+    """
+    批量 RAG 查询：一次鉴权，多条问题以受限并发调用上游
+    - stream=false：全部完成后返回 {"results":[...]}，按提交顺序排列
+    - stream=true ：application/x-ndjson，每完成一条输出一行
+    每条结果：{"index","query","ok","answer"|"error","cached","elapsed_ms"}，单条失败不影响其它条
+    限流按条计，使用批量接口自己的令牌桶（RAG_BATCH_RATE_PER_MIN / RAG_BATCH_BURST）：
+    每条未命中缓存的问题消耗一个令牌，令牌用完时排队等待，等待超过 RAG_BATCH_TOKEN_WAIT_S 的条目返回 429 错误
+    """
+    RAG_SERVICE_URL = os.getenv("RAG_SERVICE_URL", "http://localhost:11434/api/generate")
+    username = user_info.get('username', 'unknown')
+
+    if len(request.items) > RAG_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {RAG_BATCH_MAX_ITEMS} items per batch")
+
+    concurrency = min(request.concurrency or RAG_BATCH_CONCURRENCY, RAG_BATCH_CONCURRENCY)
+    sem = asyncio.Semaphore(max(concurrency, 1))
+
+    async def run(index: int, item: RAGService) -> Dict[str, Any]:
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                answer, cached = await _rag_answer(RAG_SERVICE_URL, item.query, item.model_choice, username,
+                                                   batch=True)
+                out = {"ok": True, "answer": answer, "cached": cached}
+            except HTTPException as e:
+                out = {"ok": False, "error": {"status": e.status_code, "message": e.detail}, "cached": False}
+            return {"index": index, "query": item.query, **out,
+                    "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1)}
+
+    tasks = [asyncio.create_task(run(i, item)) for i, item in enumerate(request.items)]
+    meta = {"processed_by": f"external_rag:{username}", "concurrency": concurrency}
+
+    if not request.stream:
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            for t in tasks:
+                t.cancel()
+        return {"results": results, "meta": meta}
+
+    async def lines():
+        try:
+            for fut in asyncio.as_completed(tasks):
+                yield json.dumps(await fut, ensure_ascii=False) + "\n"
+        finally:
+            # 客户端断开时取消还没跑完的条目
+            for t in tasks:
+                t.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
 @app.post("/rag/external_query_stream")
-async def rag_external_query_stream(request: RAGService, user_info: Dict[str, Any] = Depends(bearer_auth)):
+async def rag_external_query_stream(request: RAGService, raw_request: Request,
+                                    user_info: Dict[str, Any] = Depends(bearer_auth)):
     """
-    调用外部 RAG 服务进行流式查询
+    调用外部 RAG 服务进行流式查询（命中答案缓存时直接快速回放）
+    返回 text/event-stream：
+        event: delta   data: {"index":0,"delta":"..."}
+        event: result  data: {"finish_reason":"stop","usage":{...},"timing":{...},"cached":false}
+        event: error   data: {"code":"UPSTREAM_ERROR","message":"..."}
+    空闲超过 RAG_SSE_HEARTBEAT_S 秒发送 ": ping" 注释保活；客户端断开后上游流随之关闭
     """
     RAG_SERVICE_URL = os.getenv("RAG_SERVICE_URL", "http://192.168.1.254:11434/api/generate")
 
-    try:
-        # 构建发送给外部 RAG 服务的请求
-        rag_payload = {
-            "model": request.model_choice,
-            "prompt": request.query,
-            "stream": True
-        }
+    # 构建发送给外部 RAG 服务的请求
+    stream = _rag_stream(RAG_SERVICE_URL, request.model_choice, request.query)
 
-        async def generate():
-            try:
-                async with httpx.AsyncClient(timeout=30.0) as client:
-                    async with client.stream("POST", RAG_SERVICE_URL, json=rag_payload) as response:
-                        if response.status_code == 200:
-                            async for line in response.aiter_lines():
-                                if line:
-                                    try:
-                                        data = json.loads(line)
-                                        if "response" in data:
-                                            yield data["response"]
-                                    except json.JSONDecodeError:
-                                        continue
-                        else:
-                            yield json.dumps({"error": f"External RAG service error: {response.status_code}"})
-            except httpx.RequestError as e:
-                yield json.dumps({"error": f"Cannot connect to external RAG service: {str(e)}"})
-            except Exception as e:
-                yield json.dumps({"error": f"External RAG stream failed: {str(e)}"})
-
-        return generate()
+    # 开始流式响应前先做准入判断，这样还能返回 429/503 状态码；排队超时则在流内返回错误
+    # 与 /rag/external_query 一致：缓存命中不消耗限流令牌，也不占上游
+    if not stream.lookup():
+        try:
+            admission.check_user(user_info.get("username", "unknown"))
+            admission.check_capacity("ollama")
+        except AdmissionRejected as e:
+            raise _http_rejection(e)
+    coalesce = coalesce_config(env_prefix="RAG_STREAM_COALESCE")
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"External RAG stream query failed: {str(e)}")
+    async def events():
+        timer = StreamTimer()
+        index = 0
+        try:
+            deltas = coalesce_deltas(timer.wrap(stream), coalesce)
+            async for delta in with_heartbeat(deltas, RAG_SSE_HEARTBEAT_S):
+                if delta is None:
+                    if await raw_request.is_disconnected():
+                        return  # 退出时关闭整条流水线，上游连接随之断开
+                    yield ": ping\n\n"
+                    continue
+                yield _sse("delta", {"index": index, "delta": delta})
+                index += 1
+        except AdmissionRejected as e:
+            yield _sse("error", {"code": e.code, "message": str(e), "retry_after": e.retry_after})
+            return
+        except UpstreamError as e:
+            yield _sse("error", {"code": "UPSTREAM_ERROR", "message": str(e)})
+            return
+        except httpx.RequestError as e:
+            yield _sse("error", {"code": "UPSTREAM_UNAVAILABLE",
+                                 "message": f"Cannot connect to external RAG service: {str(e)}"})
+            return
+        except Exception as e:
+            yield _sse("error", {"code": "INTERNAL_ERROR", "message": f"External RAG stream failed: {str(e)}"})
+            return
+
+        result = dict(stream.result)
+        timer.connect_s = stream.connect_s
+        usage = _usage(result, timer)
+        yield _sse("result", {
+            "finish_reason": result.get("finish_reason") or "stop",
+            "usage": usage,
+            "timing": timer.finish(usage["completion_tokens"]),
+            "cached": stream.cached,
+        })
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 
 # =========================
@@ -1,7 +1,9 @@
 # deepseek_stream.py
 import os
-from typing import Iterable, List, Dict, Any, Generator
-from openai import OpenAI, OpenAIError
+import time
+from typing import Iterable, List, Dict, Any, Generator, AsyncIterator
+import httpx
+from openai import OpenAI, AsyncOpenAI, OpenAIError
 
 class DeepseekStreamer:
     """
@@ -67,6 +69,83 @@ class DeepseekStreamer:
         except Exception as e:
             raise
 
+class AsyncDeepseekStream:
+    """
+    一次异步流式调用：
+    - async for 逐个取文本增量
+    - 结束后 result 里有 finish_reason / usage / id，connect_s 为建连到响应头的耗时
+    - 所在任务被取消时关闭底层 HTTP 响应，不再继续占用上游
+    """
+    def __init__(self, client: AsyncOpenAI, model: str, messages: List[Dict[str, Any]], **kwargs):
+        self.client = client
+        self.model = model
+        self.messages = messages
+        self.kwargs = kwargs
+        self.result: Dict[str, Any] = {"finish_reason": None, "usage": None, "id": None}
+        self.connect_s: float | None = None  # 发起请求到收到响应头的耗时
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        t0 = time.perf_counter()
+        try:
+            stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=self.messages,
+                stream=True,
+                stream_options={"include_usage": True},  # 最后一帧带 usage
+                **self.kwargs,
+            )
+        except OpenAIError as e:
+            raise RuntimeError(f"DeepSeek API 调用失败: {e}") from e
+        self.connect_s = time.perf_counter() - t0
+
+        async with stream:
+            async for chunk in stream:
+                usage = getattr(chunk, "usage", None)
+                if usage is not None:
+                    self.result["usage"] = usage.model_dump() if hasattr(usage, "model_dump") else dict(usage)
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+
+                delta = getattr(choice.delta, "content", None)
+                if delta:
+                    yield delta
+
+                if choice.finish_reason is not None:
+                    self.result["finish_reason"] = choice.finish_reason
+                    self.result["id"] = getattr(chunk, "id", None)
+
+
+class AsyncDeepseekStreamer:
+    """
+    DeepseekStreamer 的异步版本，供事件循环里直接使用：
+    - 基于 AsyncOpenAI，不阻塞事件循环，也不需要每个流一个线程
+    - 可传入共享的 httpx.AsyncClient，多个流复用同一个连接池
+    """
+    def __init__(
+        self,
+        api_key: str | None = None,
+        base_url: str | None = None,
+        model: str = "deepseek-chat",
+        timeout: float | None = 60.0,
+        http_client: httpx.AsyncClient | None = None,
+    ):
+        self.api_key = api_key if api_key is not None else os.getenv("DeepSeekAPI")
+        self.base_url = base_url or "https://api.deepseek.com"
+        self.model = model
+        self.client = AsyncOpenAI(api_key=self.api_key, base_url=f"{self.base_url}/v1",
+                                  timeout=timeout, http_client=http_client)
+
+    def stream_chat(self, messages: List[Dict[str, Any]], **kwargs) -> AsyncDeepseekStream:
+        """
+        返回一个异步流对象：async for delta in ds.stream_chat(msgs): ...
+        结束后从 .result 取 finish_reason/usage
+        """
+        return AsyncDeepseekStream(self.client, self.model, messages, **kwargs)
+
+    async def aclose(self) -> None:
+        await self.client.close()
+
 # ------------------ 最小示例 ------------------
 if __name__ == "__main__":
     ds = DeepseekStreamer(model="deepseek-chat")
@@ -0,0 +1,105 @@
+# anti_spoof/batching.py
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+
+
+def pad_or_crop(x: torch.Tensor, length: int) -> torch.Tensor:
+    """[T] -> [length]：长了截取开头，短了循环重复补齐（与 AASIST 训练时的补齐方式一致）"""
+    n = x.numel()
+    if n >= length:
+        return x[:length]
+    reps = -(-length // n)
+    return x.repeat(reps)[:length]
+
+
+class MicroBatcher:
+    """
+    动态微批：多个线程并发提交的单条音频，凑够 max_batch 条或第一条等了 max_wait_ms 后合成一个 batch，
+    按长度分组，每组等长音频只跑一次 forward，再把每条的伪造概率分发回去
+    不做裁剪/补齐：同一条音频的结果与单独推理一致，不受同批其它请求影响（分窗评分的窗口都是 nb_samp，总能合批）
+    forward 只在批处理线程里执行，模型不会被并发调用
+    """
+    def __init__(self,
+                 forward: Callable[[torch.Tensor], torch.Tensor],
+                 max_batch: int = 8,
+                 max_wait_ms: float = 5.0,
+                 name: str = "aasist-batcher"):
+        self._forward = forward  # [B, T] -> [B] 伪造概率
+        self.max_batch = max(1, max_batch)
+        self.max_wait_s = max_wait_ms / 1000.0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._closed = False
+        self.batches = 0
+        self.items = 0
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, x: torch.Tensor) -> Future:
+        """提交一条 [T] 的 16k 单声道音频，返回结果为伪造概率的 Future"""
+        if self._closed:
+            raise RuntimeError("batcher is closed")
+        fut: Future = Future()
+        self._queue.put((x, fut))
+        return fut
+
+    def infer(self, x: torch.Tensor) -> float:
+        return self.submit(x).result()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait_s
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0.0))
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)  # 留给下一轮退出
+                break
+            batch.append(item)
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            groups: Dict[int, List[Tuple[torch.Tensor, Future]]] = {}
+            for x, fut in batch:
+                if fut.set_running_or_notify_cancel():
+                    groups.setdefault(x.numel(), []).append((x, fut))
+            for group in groups.values():
+                self._run(group)
+
+    def _run(self, group: List[Tuple[torch.Tensor, Future]]) -> None:
+        try:
+            probs = self._forward(torch.stack([x for x, _ in group])).tolist()
+        except BaseException as e:
+            for _, fut in group:
+                fut.set_exception(e)
+            return
+        self.batches += 1
+        self.items += len(group)
+        for (_, fut), p in zip(group, probs):
+            fut.set_result(float(p))
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": (self.items / self.batches) if self.batches else 0.0,
+            "pending": self._queue.qsize(),
+        }
+
+    def close(self, timeout: Optional[float] = 5.0) -> None:
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
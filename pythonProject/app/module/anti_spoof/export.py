@@ -0,0 +1,101 @@
+# anti_spoof/export.py
+"""
+把 AASIST 导出为 ONNX / TorchScript，并与 PyTorch eager 输出做一致性检查
+
+用法（在 app 目录下）：
+    python -m module.anti_spoof.export --format onnx --out module/anti_spoof/models/weights/AASIST.onnx
+    python -m module.anti_spoof.export --format torchscript --out module/anti_spoof/models/weights/AASIST.pt
+
+导出图只含推理分支（eval、无频带掩码增强、无 dropout），输入 audio [B, nb_samp]，输出 spoof_prob [B]；
+batch 维是动态的。时间图池化的 top-k 节点数由输入长度在 Python 里算出，追踪时会被固定，
+所以长度维固定为 nb_samp，AASISTDetector 会把输入裁剪/补齐到该长度（分窗评分本来就是这个长度）
+"""
+import argparse
+import sys
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+from .inference import load_model
+from .models.AASIST import Model
+from .runtime import OnnxRunner, TorchScriptRunner
+
+
+class SpoofProbHead(nn.Module):
+    """Model + softmax，只输出伪造概率"""
+    def __init__(self, model: Model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        _, logits = self.model(x)
+        return torch.softmax(logits, dim=1)[:, 1]
+
+
+def _prepare(model: Model) -> SpoofProbHead:
+    # 导出时用完整注意力图：分块循环会按固定节点数展开，图更大也没有收益
+    for m in model.modules():
+        if hasattr(m, "att_chunk"):
+            m.att_chunk = 0
+    return SpoofProbHead(model).eval()
+
+
+@torch.no_grad()
+def export_onnx(model: Model, out: str, nb_samp: int, opset: int = 17) -> None:
+    head = _prepare(model)
+    example = torch.randn(2, nb_samp)
+    torch.onnx.export(head, (example,), out,
+                      input_names=["audio"],
+                      output_names=["spoof_prob"],
+                      dynamic_axes={"audio": {0: "batch"}, "spoof_prob": {0: "batch"}},
+                      opset_version=opset,
+                      do_constant_folding=True)
+
+
+@torch.no_grad()
+def export_torchscript(model: Model, out: str, nb_samp: int) -> None:
+    head = _prepare(model)
+    traced = torch.jit.trace(head, torch.randn(2, nb_samp))
+    torch.jit.save(torch.jit.freeze(traced), out)
+
+
+@torch.no_grad()
+def check_parity(model: Model, path: str, fmt: str, nb_samp: int, batch: int = 3) -> float:
+    """随机输入下导出结果与 eager 的最大绝对误差（batch 与导出时不同，顺带验证动态 batch）"""
+    runner = OnnxRunner(path) if fmt == "onnx" else TorchScriptRunner(path, length=nb_samp)
+    X = torch.randn(batch, nb_samp)
+    expected = SpoofProbHead(model).eval()(X)
+    return (runner(X) - expected).abs().max().item()
+
+
+def main(argv=None) -> int:
+    app_dir = Path(__file__).resolve().parents[2]
+    p = argparse.ArgumentParser(description="Export AASIST to ONNX / TorchScript")
+    p.add_argument("--conf", default=str(app_dir / "config" / "AASIST.conf"))
+    p.add_argument("--weights", default=str(app_dir / "module" / "anti_spoof" / "models" / "weights" / "AASIST.pth"))
+    p.add_argument("--format", choices=("onnx", "torchscript"), default="onnx")
+    p.add_argument("--out", required=True)
+    p.add_argument("--opset", type=int, default=17)
+    p.add_argument("--atol", type=float, default=1e-4, help="一致性检查允许的最大误差")
+    p.add_argument("--no-check", action="store_true", help="跳过与 eager 的一致性检查")
+    args = p.parse_args(argv)
+
+    model, cfg = load_model(args.conf, args.weights)
+    nb_samp = cfg["model_config"]["nb_samp"]
+    if args.format == "onnx":
+        export_onnx(model, args.out, nb_samp, args.opset)
+    else:
+        export_torchscript(model, args.out, nb_samp)
+    print(f"exported {args.format} -> {args.out}")
+
+    if args.no_check:
+        return 0
+    diff = check_parity(model, args.out, args.format, nb_samp)
+    ok = diff <= args.atol
+    print(f"parity {'OK' if ok else 'FAILED'}: max |exported - eager| = {diff:.2e} (atol {args.atol})")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,89 +1,234 @@
 # anti_spoof/inference.py
-import torch, torchaudio, yaml, numpy as np
+import io
+import torch, yaml, numpy as np
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import BinaryIO, List, Optional, Tuple, Union
 from .models.AASIST import Model
+from .batching import MicroBatcher, pad_or_crop
+from .vad import speech_segments
+from . import resample
+from .runtime import OnnxRunner, TorchScriptRunner
 import soundfile as sf
 
+
+def load_model(conf_path: str, weight_path: Optional[str] = None, device: str = "cpu") -> Tuple[Model, dict]:
+    """读取配置和权重，返回 (eval 模式的 Model, 配置)"""
+    with open(conf_path, "r", encoding="utf-8") as f:
+        cfg = yaml.safe_load(f)  # AASIST.conf 是 JSON 也可用 safe_load 解析
+    model = Model(cfg["model_config"]).to(device).eval()
+    ckpt = weight_path or cfg["inference"]["pretrained_ckpt"]
+    sd = torch.load(ckpt, map_location=device)
+    sd = sd["state_dict"] if isinstance(sd, dict) and "state_dict" in sd else sd
+    model.load_state_dict(sd, strict=False)
+    return model, cfg
+
+
 class AASISTDetector:
     def __init__(self,
                  conf_path: str = "config/AASIST.conf",
                  weight_path: Optional[str] = None,
                  use_cuda: bool = True,
                  min_duration_sec: float = 2.0,
-                 vad: bool = True):
+                 vad: bool = False,
+                 vad_trim: bool = False,
+                 min_speech_ratio: float = 0.3,
+                 batch_size: int = 1,
+                 batch_wait_ms: float = 5.0,
+                 segmented: bool = False,
+                 segment_hop: Optional[int] = None,
+                 segment_batch: int = 8,
+                 aggregate: str = "mean",
+                 quantile: float = 0.9,
+                 early_exit: int = 0,
+                 threshold: float = 0.5,
+                 resample_fast: bool = False,
+                 preload_rates: Tuple[int, ...] = (8000, 44100, 48000),
+                 backend: str = "torch",
+                 artifact_path: Optional[str] = None,
+                 ort_threads: int = 0):
+        """
+        vad=True 时用向量化的能量/过零率 VAD 找出人声区间，人声占比低于 min_speech_ratio 判为无效；
+        vad_trim=True 时只把人声区间拼接后送进模型，跳过静音；两者默认关闭
+        （行为检查见 Test/vad_behavior_check.py）
+        batch_size > 1 时开启动态微批：并发线程调用 score_* 时合批推理，
+        同一批里只有等长的音频一起推理，结果与不合批时相同
+        segmented=True 时长于 nb_samp 的音频按 nb_samp 窗口、segment_hop 步长切分，
+        每次最多 segment_batch 个窗口一起推理，窗口概率按 aggregate（mean/max/quantile）汇总；
+        early_exit > 0 时，已评分窗口数达到该值且全部落在 threshold 同一侧就提前结束
+        重采样核按采样率缓存，preload_rates 中的采样率启动时预先构建；resample_fast=True 用更短的核
+        backend：torch（默认，eager）/ onnx（ONNX Runtime CPU）/ torchscript，
+        后两者加载 export.py 导出的 artifact_path，输入长度固定为 nb_samp，因此必须配合 segmented=True，
+        否则长音频只能截取开头一个窗口，结果与 torch 后端不一致（直接抛 ValueError）
+        """
+        if backend != "torch" and not segmented:
+            raise ValueError(f"backend={backend} 的输入长度固定为 nb_samp，需要 segmented=True")
         self.device = "cuda" if (use_cuda and torch.cuda.is_available()) else "cpu"
-        with open(conf_path, "r", encoding="utf-8") as f:
-            cfg = yaml.safe_load(f)  # AASIST.conf 是 JSON 也可用 safe_load 解析
+        self.backend = backend
+        self.model = None
+        self._runner = None
+        if backend == "torch":
+            self.model, cfg = load_model(conf_path, weight_path, self.device)
+        else:
+            with open(conf_path, "r", encoding="utf-8") as f:
+                cfg = yaml.safe_load(f)
+            if not artifact_path:
+                raise ValueError(f"backend={backend} 需要 artifact_path")
+            if backend == "onnx":
+                self._runner = OnnxRunner(artifact_path, ort_threads)
+            elif backend == "torchscript":
+                self._runner = TorchScriptRunner(artifact_path, self.device,
+                                                 length=cfg["model_config"].get("nb_samp"))
+            else:
+                raise ValueError(f"unknown backend: {backend}")
         self.cfg = cfg
-        self.model = Model(cfg["model_config"]).to(self.device).eval()
-        ckpt = weight_path or cfg["inference"]["pretrained_ckpt"]
-        sd = torch.load(ckpt, map_location=self.device)
-        sd = sd["state_dict"] if isinstance(sd, dict) and "state_dict" in sd else sd
-        self.model.load_state_dict(sd, strict=False)
+
+        self.nb_samp = cfg["model_config"].get("nb_samp")
+        self.batcher = None
+        if batch_size > 1:
+            self.batcher = MicroBatcher(self._forward_probs, max_batch=batch_size,
+                                        max_wait_ms=batch_wait_ms)
+
+        self.segmented = segmented and bool(self.nb_samp)
+        self.segment_hop = segment_hop or self.nb_samp
+        self.segment_batch = max(1, segment_batch)
+        self.aggregate = aggregate
+        self.quantile = quantile
+        self.early_exit = early_exit
+        self.threshold = threshold
+
+        self.resample_fast = resample_fast
+        resample.preload(preload_rates, resample_fast)
 
         self.min_dur = min_duration_sec
         self.enable_vad = vad
-        try:
-            import webrtcvad  # 可选
-            self._vad = webrtcvad.Vad(2)
-        except Exception:
-            self._vad = None
-            self.enable_vad = False
+        self.vad_trim = vad_trim
+        self.min_speech_ratio = min_speech_ratio
+
+    def _to_mono16k(self, wav: torch.Tensor, sr: int) -> torch.Tensor:
+        return resample.to_mono16k(wav, sr, self.resample_fast)  # [T]
+
+    def _speech_segments(self, x_16k: torch.Tensor) -> List[Tuple[int, int]]:
+        if not self.enable_vad:
+            return [(0, x_16k.numel())]
+        return speech_segments(x_16k.cpu().numpy(), 16000)
+
+    @torch.no_grad()
+    def _forward_probs(self, X: torch.Tensor) -> torch.Tensor:
+        """[B, T] -> [B] 伪造概率"""
+        if self._runner is not None:
+            return self._runner(X)
+        _, logits = self.model(X.to(self.device))
+        return torch.softmax(logits, dim=1)[:, 1].cpu()
+
+    def _infer(self, x: torch.Tensor) -> float:
+        """单条 [T] 推理；开启微批时交给批处理线程"""
+        if self.batcher is not None:
+            return self.batcher.infer(x)
+        return self._forward_probs(x.unsqueeze(0))[0].item()
+
+    def _infer_many(self, X: torch.Tensor) -> List[float]:
+        """[B, T] 一组等长窗口推理；开启微批时逐条提交，和其它请求一起合批"""
+        if self.batcher is not None:
+            futures = [self.batcher.submit(w) for w in X]
+            return [f.result() for f in futures]
+        return self._forward_probs(X).tolist()
+
+    def _aggregate(self, probs: List[float]) -> float:
+        p = torch.tensor(probs)
+        if self.aggregate == "max":
+            return p.max().item()
+        if self.aggregate == "quantile":
+            return torch.quantile(p, self.quantile).item()
+        return p.mean().item()
+
+    @torch.no_grad()
+    def score_segments(self, x: torch.Tensor) -> Tuple[float, dict]:
+        """
+        [T] 分窗评分：窗口是原音频的视图（unfold 不复制），每批只拷贝 segment_batch 个窗口，
+        峰值内存与音频长度无关；末尾不足一个步长的部分补一个贴齐结尾的窗口
+        """
+        win, hop = self.nb_samp, self.segment_hop
+        if x.numel() <= win:
+            prob = self._infer_many(pad_or_crop(x, win).unsqueeze(0))[0]
+            return prob, {"windows": 1, "windows_scored": 1}
+
+        windows = x.unfold(0, win, hop)  # [N, win]，共享 x 的存储
+        n = windows.size(0)
+        tail = (x.numel() - win) % hop != 0
+        total = n + int(tail)
+
+        probs: List[float] = []
+        for start in range(0, total, self.segment_batch):
+            end = min(start + self.segment_batch, total)
+            batch = windows[start:min(end, n)]
+            if tail and end == total:
+                batch = torch.cat([batch, x[-win:].unsqueeze(0)])
+            probs.extend(self._infer_many(batch.contiguous()))
+
+            if self.early_exit and len(probs) >= self.early_exit:
+                spoof = [p >= self.threshold for p in probs]
+                if all(spoof) or not any(spoof):
+                    break
+        return self._aggregate(probs), {"windows": total, "windows_scored": len(probs)}
+
+    def close(self) -> None:
+        if self.batcher is not None:
+            self.batcher.close()
 
     @staticmethod
-    def _to_mono16k(wav: torch.Tensor, sr: int) -> torch.Tensor:
-        if wav.dim() == 2 and wav.size(0) > 1:
-            wav = wav[:1, :]
-        if sr != 16000:
-            wav = torchaudio.functional.resample(wav, sr, 16000)
-        return wav.squeeze(0)  # [T]
-
-    def _speech_ratio(self, x_16k: np.ndarray) -> float:
-        if not self.enable_vad or self._vad is None:
-            return 1.0
-        import struct
-        sr = 16000
-        frame = int(0.02 * sr)  # 20ms
-        pcm = (np.clip(x_16k, -1, 1) * 32768).astype(np.int16).tobytes()
-        n = len(pcm) // (2 * frame)
-        speech = 0
-        for i in range(n):
-            chunk = pcm[i*2*frame:(i+1)*2*frame]
-            if self._vad.is_speech(chunk, sr): speech += 1
-        return speech / max(n, 1)
+    def _read_audio(source: Union[str, Path, bytes, bytearray, memoryview, BinaryIO]) -> Tuple[np.ndarray, int]:
+        """文件路径 / 内存中的字节 / 文件对象都直接解码，不落临时文件"""
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        return sf.read(source, dtype="float32", always_2d=False)
 
     @torch.no_grad()
-    def score_wav(self, path: str) -> Tuple[float, dict]:
+    def score_wav(self, source: Union[str, Path, bytes, bytearray, memoryview, BinaryIO]) -> Tuple[float, dict]:
+        """source 可以是文件路径、音频文件的字节内容或文件对象"""
 
         # 读取音频
-        data, sr = sf.read(path, dtype="float32", always_2d=False)  # sr为采样率
+        data, sr = self._read_audio(source)  # sr为采样率
         if data.ndim == 2:
-            data = data.mean(axis=1)
-        wav = torch.from_numpy(np.asarray(data, dtype=np.float32))[None, :]  # [1, T]
+            data = data.mean(axis=1)  # 先混成单声道，重采样只处理一个声道
+        wav = torch.from_numpy(data)  # [T]，sf.read 已是 float32，不再拷贝
 
         # 重采样 + 预处理
         x = self._to_mono16k(wav, sr)       # [T]  转化为16k单声道
         dur = x.numel() / 16000.0           # 计算时长 = 样本点数/采样率
 
         # 计算语音占比
-        speech_ratio = self._speech_ratio(x.cpu().numpy()) if self.enable_vad else 1.0
+        segments = self._speech_segments(x)
+        speech = sum(e - s for s, e in segments)
+        speech_ratio = speech / max(x.numel(), 1)
         meta = {"duration": dur, "speech_ratio": speech_ratio}
 
         # 过滤掉无效样本  时间过短或者人声占比太小都会直接过滤
-        if dur < self.min_dur or speech_ratio < 0.3:
+        if dur < self.min_dur or speech_ratio < self.min_speech_ratio:
             return float("nan"), {**meta, "reason": "时间过短或者人声占比太小"}
 
+        # 只保留人声区间，静音部分不进模型
+        if self.vad_trim and speech < x.numel():
+            x = torch.cat([x[s:e] for s, e in segments])
+
         # 符合条件，开始调用模型处理
-        # AASIST 期待 [B, T]
-        X = x.unsqueeze(0).to(self.device)
-        _, logits = self.model(X)
-        prob_spoof = torch.softmax(logits, dim=1)[0, 1].item()
+        if self.segmented:
+            prob_spoof, seg_meta = self.score_segments(x)
+            return prob_spoof, {**meta, **seg_meta}
+        prob_spoof = self._infer(x)
         return prob_spoof, meta
 
     @torch.no_grad()
     def score_tensor(self, x: torch.Tensor, sr: int) -> float:
         x = self._to_mono16k(x, sr)           # [T]
-        X = x.unsqueeze(0).to(self.device)
-        _, logits = self.model(X)
-        return torch.softmax(logits, dim=1)[0, 1].item()
+        if self.segmented:
+            return self.score_segments(x)[0]
+        return self._infer(x)
+
+    @torch.no_grad()
+    def score_window(self, window: np.ndarray) -> float:
+        """实时流里的一个 16k 单声道窗口（长度 nb_samp），不做时长 / VAD 校验"""
+        return self._infer(torch.from_numpy(window))
+
+    def resample_to_16k(self, x: np.ndarray, sr: int) -> np.ndarray:
+        """单声道 numpy 片段重采样到 16k，供实时流使用"""
+        return self._to_mono16k(torch.from_numpy(np.ascontiguousarray(x)), sr).numpy()
@@ -13,6 +13,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch import Tensor
 
+# default number of query nodes per chunk when building graph attention maps
+# at inference time; 0 falls back to the full (#node x #node x #dim) tensor
+ATT_CHUNK = 32
+
 
 class GraphAttentionLayer(nn.Module):
     def __init__(self, in_dim, out_dim, **kwargs):
@@ -40,6 +44,9 @@ class GraphAttentionLayer(nn.Module):
         if "temperature" in kwargs:
             self.temp = kwargs["temperature"]
 
+        # nodes per chunk for the memory-bounded attention map (eval only)
+        self.att_chunk = kwargs.get("att_chunk", ATT_CHUNK)
+
     def forward(self, x):
         '''
         x   :(#bs, #node, #dim)
@@ -48,7 +55,10 @@ class GraphAttentionLayer(nn.Module):
         x = self.input_drop(x)
 
         # derive attention map
-        att_map = self._derive_att_map(x)
+        if self.training or not self.att_chunk:
+            att_map = self._derive_att_map(x)
+        else:
+            att_map = self._derive_att_map_chunked(x)
 
         # projection
         x = self._project(x, att_map)
@@ -90,6 +100,28 @@ class GraphAttentionLayer(nn.Module):
 
         return att_map
 
+    def _derive_att_map_chunked(self, x):
+        '''
+        Same result as _derive_att_map, but the (#bs, #node, #node, #dim)
+        pairwise tensor is only materialised for att_chunk rows at a time.
+        x           :(#bs, #node, #dim)
+        out_shape   :(#bs, #node, #node, 1)
+        '''
+        bs, nb_nodes, _ = x.size()
+        att_map = x.new_empty(bs, nb_nodes, nb_nodes, 1)
+        for i in range(0, nb_nodes, self.att_chunk):
+            j = min(i + self.att_chunk, nb_nodes)
+            pair = x[:, i:j].unsqueeze(2) * x.unsqueeze(1)
+            att_map[:, i:j] = torch.matmul(
+                torch.tanh(self.att_proj(pair)), self.att_weight)
+
+        # apply temperature
+        att_map = att_map / self.temp
+
+        att_map = F.softmax(att_map, dim=-2)
+
+        return att_map
+
     def _project(self, x, att_map):
         x1 = self.proj_with_att(torch.matmul(att_map.squeeze(-1), x))
         x2 = self.proj_without_att(x)
@@ -147,6 +179,9 @@ class HtrgGraphAttentionLayer(nn.Module):
         if "temperature" in kwargs:
             self.temp = kwargs["temperature"]
 
+        # nodes per chunk for the memory-bounded attention map (eval only)
+        self.att_chunk = kwargs.get("att_chunk", ATT_CHUNK)
+
     def forward(self, x1, x2, master=None):
         '''
         x1  :(#bs, #node, #dim)
@@ -167,7 +202,10 @@ class HtrgGraphAttentionLayer(nn.Module):
         x = self.input_drop(x)
 
         # derive attention map
-        att_map = self._derive_att_map(x, num_type1, num_type2)
+        if self.training or not self.att_chunk:
+            att_map = self._derive_att_map(x, num_type1, num_type2)
+        else:
+            att_map = self._derive_att_map_chunked(x, num_type1, num_type2)
 
         # directional edge for master node
         master = self._update_master(x, master)
@@ -254,6 +292,36 @@ class HtrgGraphAttentionLayer(nn.Module):
 
         return att_map
 
+    def _derive_att_map_chunked(self, x, num_type1, num_type2):
+        '''
+        Same result as _derive_att_map, but the (#bs, #node, #node, #dim)
+        pairwise tensor is only materialised for att_chunk rows at a time.
+        Chunks never straddle the type1/type2 boundary, so each chunk uses
+        one weight per column block.
+        x           :(#bs, #node, #dim)
+        out_shape   :(#bs, #node, #node, 1)
+        '''
+        bs, nb_nodes, _ = x.size()
+        att_map = x.new_empty(bs, nb_nodes, nb_nodes, 1)
+        for lo, hi, w_left, w_right in (
+                (0, num_type1, self.att_weight11, self.att_weight12),
+                (num_type1, nb_nodes, self.att_weight12, self.att_weight22)):
+            for i in range(lo, hi, self.att_chunk):
+                j = min(i + self.att_chunk, hi)
+                pair = x[:, i:j].unsqueeze(2) * x.unsqueeze(1)
+                pair = torch.tanh(self.att_proj(pair))
+                att_map[:, i:j, :num_type1] = torch.matmul(
+                    pair[:, :, :num_type1], w_left)
+                att_map[:, i:j, num_type1:] = torch.matmul(
+                    pair[:, :, num_type1:], w_right)
+
+        # apply temperature
+        att_map = att_map / self.temp
+
+        att_map = F.softmax(att_map, dim=-2)
+
+        return att_map
+
     def _project(self, x, att_map):
         x1 = self.proj_with_att(torch.matmul(att_map.squeeze(-1), x))
         x2 = self.proj_without_att(x)
@@ -375,7 +443,7 @@ class CONV(nn.Module):
         self.mel = filbandwidthsf
         self.hsupp = torch.arange(-(self.kernel_size - 1) / 2,
                                   (self.kernel_size - 1) / 2 + 1)
-        self.band_pass = torch.zeros(self.out_channels, self.kernel_size)
+        band_pass = torch.zeros(self.out_channels, self.kernel_size)
         for i in range(len(self.mel) - 1):
             fmin = self.mel[i]
             fmax = self.mel[i + 1]
@@ -385,24 +453,32 @@ class CONV(nn.Module):
                 np.sinc(2*fmin*self.hsupp/self.sample_rate)
             hideal = hHigh - hLow
 
-            self.band_pass[i, :] = Tensor(np.hamming(
+            band_pass[i, :] = Tensor(np.hamming(
                 self.kernel_size)) * Tensor(hideal)
 
+        # precomputed filter bank, moved with the module by .to(); not part of
+        # the state dict so existing checkpoints load unchanged
+        self.register_buffer("filters",
+                             band_pass.view(self.out_channels, 1, self.kernel_size),
+                             persistent=False)
+
+    @property
+    def band_pass(self):
+        return self.filters.view(self.out_channels, self.kernel_size)
+
     def forward(self, x, mask=False):
-        band_pass_filter = self.band_pass.clone().to(x.device)
-        if mask:
+        # forward never writes module state, so one instance can serve
+        # concurrent inference threads
+        filters = self.filters
+        if mask and self.training:
             A = np.random.uniform(0, 20)
             A = int(A)
-            A0 = random.randint(0, band_pass_filter.shape[0] - A)
-            band_pass_filter[A0:A0 + A, :] = 0
-        else:
-            band_pass_filter = band_pass_filter
-
-        self.filters = (band_pass_filter).view(self.out_channels, 1,
-                                               self.kernel_size)
+            A0 = random.randint(0, self.out_channels - A)
+            filters = filters.clone()
+            filters[A0:A0 + A] = 0
 
         return F.conv1d(x,
-                        self.filters,
+                        filters,
                         stride=self.stride,
                         padding=self.padding,
                         dilation=self.dilation,
@@ -558,7 +634,7 @@ class Model(nn.Module):
 
         # inference 1
         out_T1, out_S1, master1 = self.HtrgGAT_layer_ST11(
-            out_T, out_S, master=self.master1)
+            out_T, out_S, master=master1)
 
         out_S1 = self.pool_hS1(out_S1)
         out_T1 = self.pool_hT1(out_T1)
@@ -571,7 +647,7 @@ class Model(nn.Module):
 
         # inference 2
         out_T2, out_S2, master2 = self.HtrgGAT_layer_ST21(
-            out_T, out_S, master=self.master2)
+            out_T, out_S, master=master2)
         out_S2 = self.pool_hS2(out_S2)
         out_T2 = self.pool_hT2(out_T2)
 
@@ -0,0 +1,59 @@
+# anti_spoof/resample.py
+import threading
+from typing import Dict, Iterable, Tuple
+
+import torch
+import torchaudio
+
+TARGET_SR = 16000
+
+# fast=False 与 torchaudio.functional.resample 的默认参数一致（结果相同）；
+# fast=True 用更短的 sinc 核，卷积量约减半，高频过渡带略宽，对 16k 检测影响很小
+_KERNEL_PARAMS = {
+    False: {"lowpass_filter_width": 6, "rolloff": 0.99},
+    True: {"lowpass_filter_width": 3, "rolloff": 0.95},
+}
+
+# 只缓存常见采样率的重采样核：缓存大小有上限，上传文件里的任意采样率不会让缓存无限增长
+CACHED_RATES = frozenset((8000, 11025, 22050, 24000, 32000, 44100, 48000))
+
+_cache: Dict[Tuple[int, bool], torchaudio.transforms.Resample] = {}
+_lock = threading.Lock()
+
+
+def get_resampler(sr: int, fast: bool = False) -> torchaudio.transforms.Resample:
+    """
+    重采样模块：CACHED_RATES 中的采样率按 (源采样率, 模式) 缓存，sinc 插值核只在第一次用到时构建；
+    其它采样率每次临时构建，用完即丢
+    """
+    if sr not in CACHED_RATES:
+        return torchaudio.transforms.Resample(sr, TARGET_SR, **_KERNEL_PARAMS[fast]).eval()
+    key = (sr, fast)
+    resampler = _cache.get(key)
+    if resampler is None:
+        with _lock:
+            resampler = _cache.get(key)
+            if resampler is None:
+                resampler = torchaudio.transforms.Resample(sr, TARGET_SR, **_KERNEL_PARAMS[fast]).eval()
+                _cache[key] = resampler
+    return resampler
+
+
+def preload(rates: Iterable[int], fast: bool = False) -> None:
+    """启动时预先构建常见采样率（电话 8k、44.1k、48k）的重采样核，不在 CACHED_RATES 中的忽略"""
+    for sr in rates:
+        if sr in CACHED_RATES:
+            get_resampler(sr, fast)
+
+
+@torch.no_grad()
+def to_mono16k(wav: torch.Tensor, sr: int, fast: bool = False) -> torch.Tensor:
+    """
+    [T] 或 [C, T] -> [T] 16k 单声道：先混成单声道再重采样（只对一个声道做卷积），
+    已经是 16k 单声道时原样返回，不拷贝
+    """
+    if wav.dim() == 2:
+        wav = wav[0] if wav.size(0) == 1 else wav.mean(dim=0)
+    if sr == TARGET_SR:
+        return wav
+    return get_resampler(sr, fast)(wav)
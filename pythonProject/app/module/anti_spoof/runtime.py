@@ -0,0 +1,55 @@
+# anti_spoof/runtime.py
+from typing import Optional
+
+import numpy as np
+import torch
+
+from .batching import pad_or_crop
+
+try:
+    import onnxruntime as ort  # 可选：backend="onnx" 时需要
+except ImportError:
+    ort = None
+
+
+def _fit_length(X: torch.Tensor, length: Optional[int]) -> torch.Tensor:
+    """导出图的采样点数是固定的：逐条裁剪/循环补齐到该长度"""
+    if not length or X.size(1) == length:
+        return X
+    return torch.stack([pad_or_crop(x, length) for x in X])
+
+
+class OnnxRunner:
+    """
+    用 ONNX Runtime（CPU）运行导出的 AASIST 图：输入 audio [B, T]，输出 spoof_prob [B]
+    batch 维是动态的；长度维若导出时固定，输入会被裁剪/补齐到该长度
+    """
+    def __init__(self, path: str, threads: int = 0):
+        if ort is None:
+            raise RuntimeError("backend=onnx 需要安装 onnxruntime")
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            opts.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, sess_options=opts, providers=["CPUExecutionProvider"])
+        inp = self.session.get_inputs()[0]
+        self.input_name = inp.name
+        self.length = inp.shape[1] if isinstance(inp.shape[1], int) else None
+
+    def __call__(self, X: torch.Tensor) -> torch.Tensor:
+        X = _fit_length(X.float().cpu(), self.length)
+        (probs,) = self.session.run(None, {self.input_name: np.ascontiguousarray(X.numpy())})
+        return torch.from_numpy(probs)
+
+
+class TorchScriptRunner:
+    """加载导出的 TorchScript（已 freeze，只含推理分支），接口同 OnnxRunner"""
+    def __init__(self, path: str, device: str = "cpu", length: Optional[int] = None):
+        self.device = device
+        self.module = torch.jit.load(path, map_location=device).eval()
+        self.length = length
+
+    @torch.no_grad()
+    def __call__(self, X: torch.Tensor) -> torch.Tensor:
+        X = _fit_length(X, self.length)
+        return self.module(X.to(self.device)).cpu()
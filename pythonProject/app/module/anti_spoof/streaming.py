@@ -0,0 +1,135 @@
+# anti_spoof/streaming.py
+import math
+from typing import Callable, Iterator, Optional, Tuple
+
+import numpy as np
+
+PCM_FORMATS = {"s16le": np.int16, "f32le": np.float32}
+
+
+class StreamingWindower:
+    """
+    实时音频分窗：接收任意长度的原始 PCM 片段，维护一个固定大小（win 个 16k 采样点）的滚动缓冲，
+    每凑满一个窗口产出一次，然后前移 hop 个采样点；每个连接的内存只有一个窗口加一个片段的大小
+    sample_rate 不是 16k 时用 resample(np.ndarray, sr) -> np.ndarray 做流式重采样：
+    每次只处理整数个重采样周期的源采样点，两侧各带 _ctx 个源采样点的上下文（左边是已处理的历史，右边先留着），
+    输出去掉上下文对应的部分，结果与整段一次重采样一致，片段之间没有边缘伪影，长度也不会漂移；代价是 _ctx 个采样点的延迟
+    """
+    def __init__(self,
+                 win: int,
+                 hop: Optional[int] = None,
+                 sample_rate: int = 16000,
+                 channels: int = 1,
+                 fmt: str = "s16le",
+                 resample: Optional[Callable[[np.ndarray, int], np.ndarray]] = None):
+        if fmt not in PCM_FORMATS:
+            raise ValueError(f"unsupported pcm format: {fmt}")
+        if hop is not None and hop <= 0:
+            raise ValueError(f"hop must be positive: {hop}")
+        if channels < 1:
+            raise ValueError(f"channels must be positive: {channels}")
+        if sample_rate != 16000 and resample is None:
+            raise ValueError("resample is required when sample_rate != 16000")
+        self.win = win
+        self.hop = hop or win
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.dtype = PCM_FORMATS[fmt]
+        self.resample = resample
+        self._frame_bytes = np.dtype(self.dtype).itemsize * self.channels
+        self._buf = np.zeros(win, dtype=np.float32)
+        self._fill = 0
+        self._skip = 0       # hop > win 时两个窗口之间要跳过的采样点
+        self._rem = b""      # 不足一个采样帧的尾巴，留给下一个片段
+        self._x = np.zeros(0, dtype=np.float32)  # 已解码、还没放进窗口的 16k 采样点
+        self._pos = 0
+        self.index = 0       # 下一个窗口的序号
+        self.start = 0       # 下一个窗口起点（16k 采样点，从流开始计）
+        if self.needs_resample:
+            g = math.gcd(sample_rate, 16000)
+            self._period = sample_rate // g  # 每 _period 个源采样点正好对应 _out_period 个 16k 采样点
+            self._out_period = 16000 // g
+            # 上下文需覆盖 sinc 核宽度（源采样点数，远小于 8ms），取整到周期的倍数
+            self._ctx = -(-max(sample_rate * 8 // 1000, 1) // self._period) * self._period
+            self._hist = np.zeros(self._ctx, dtype=np.float32)  # 开头补零，与整段重采样的边界处理相同
+            self._pending = np.zeros(0, dtype=np.float32)       # 尚未重采样的源采样点
+
+    @property
+    def needs_resample(self) -> bool:
+        return self.sample_rate != 16000
+
+    def _decode(self, data: bytes) -> np.ndarray:
+        if self._rem:
+            data = self._rem + data
+        n = len(data) // self._frame_bytes * self._frame_bytes
+        self._rem = data[n:]
+        x = np.frombuffer(data, dtype=self.dtype, count=n // np.dtype(self.dtype).itemsize)
+        if self.channels > 1:
+            x = x.reshape(-1, self.channels).mean(axis=1)
+        if self.dtype == np.int16:
+            x = x.astype(np.float32) / 32768.0
+        x = np.asarray(x, dtype=np.float32)
+        if self.needs_resample:
+            x = self._resample(x)
+        return x
+
+    def _resample(self, x: np.ndarray) -> np.ndarray:
+        pending = np.concatenate([self._pending, x]) if self._pending.size else x
+        ctx, period = self._ctx, self._period
+        n = (pending.size - ctx) // period * period  # 右侧留够 ctx 个上下文后可处理的整周期部分
+        if n <= 0:
+            self._pending = pending
+            return np.zeros(0, dtype=np.float32)
+        seg = np.concatenate([self._hist, pending[:n + ctx]])
+        y = self.resample(seg, self.sample_rate)
+        lo = ctx // period * self._out_period
+        hi = (ctx + n) // period * self._out_period
+        self._hist = seg[n:n + ctx].copy()  # 处理完部分的最后 ctx 个采样点
+        self._pending = pending[n:].copy()
+        return np.asarray(y[lo:hi], dtype=np.float32)
+
+    def push(self, data: bytes) -> None:
+        """写入一个 PCM 片段（解码 / 重采样后暂存，窗口由 next_window 逐个取出）"""
+        x = self._decode(data)
+        if self._pos < self._x.size:
+            x = np.concatenate([self._x[self._pos:], x])
+        self._x, self._pos = x, 0
+
+    def next_window(self) -> Optional[Tuple[int, float, np.ndarray]]:
+        """
+        从已写入的采样点里取下一个凑满的窗口：(序号, 起始秒, [win] 音频副本)，不够一个窗口时返回 None
+        每次只拷贝一个窗口，调用方处理完再取下一个，内存不随一个片段里能凑出的窗口数增长
+        """
+        x = self._x
+        while self._pos < x.size:
+            if self._skip:
+                n = min(self._skip, x.size - self._pos)
+                self._skip -= n
+                self._pos += n
+                continue
+            take = min(self.win - self._fill, x.size - self._pos)
+            self._buf[self._fill:self._fill + take] = x[self._pos:self._pos + take]
+            self._fill += take
+            self._pos += take
+            if self._fill == self.win:
+                out = (self.index, self.start / 16000.0, self._buf.copy())
+                self.index += 1
+                self.start += self.hop
+                keep = self.win - self.hop
+                if keep > 0:
+                    self._buf[:keep] = self._buf[self.hop:]
+                    self._fill = keep
+                else:
+                    self._fill = 0
+                    self._skip = -keep
+                return out
+        return None
+
+    def feed(self, data: bytes) -> Iterator[Tuple[int, float, np.ndarray]]:
+        """push + 逐个产出窗口（惰性，不会把一个片段的所有窗口副本同时留在内存里）"""
+        self.push(data)
+        while True:
+            item = self.next_window()
+            if item is None:
+                return
+            yield item
@@ -0,0 +1,80 @@
+# anti_spoof/vad.py
+from typing import List, Tuple
+
+import numpy as np
+
+
+def frame_speech_mask(x: np.ndarray,
+                      sr: int = 16000,
+                      frame_ms: float = 20.0,
+                      floor_db: float = -50.0,
+                      margin_db: float = 12.0,
+                      noise_ceil_db: float = -50.0,
+                      zcr_max: float = 0.25) -> np.ndarray:
+    """
+    逐帧判断是否为人声（整段一次向量化计算，没有 Python 循环）：
+    - 帧能量 (dBFS) 高于 max(floor_db, 噪声底 + margin_db)，噪声底取能量的 10% 分位，且不超过 noise_ceil_db：
+      没有停顿的连续语音 / TTS 的 10% 分位本身就是人声，不封顶的话阈值会高过大部分人声帧
+    - 过零率高于 zcr_max 的帧视为噪声，除非能量比阈值再高 10 dB（清辅音）
+    返回 [帧数] 的 bool 数组，末尾不足一帧的部分忽略
+    """
+    frame = int(sr * frame_ms / 1000)
+    n = x.size // frame
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+    frames = x[:n * frame].reshape(n, frame)
+
+    energy_db = 10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+    zcr = np.mean(np.signbit(frames[:, 1:]) != np.signbit(frames[:, :-1]), axis=1)
+
+    noise_db = min(float(np.percentile(energy_db, 10)), noise_ceil_db)
+    thresh = max(floor_db, noise_db + margin_db)
+    loud = energy_db > thresh
+    return loud & ((zcr < zcr_max) | (energy_db > thresh + 10.0))
+
+
+def _runs(mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """连续 True 段的 [起点, 终点) 帧下标"""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def speech_segments(x: np.ndarray,
+                    sr: int = 16000,
+                    frame_ms: float = 20.0,
+                    min_speech_ms: float = 200.0,
+                    min_silence_ms: float = 300.0,
+                    pad_ms: float = 100.0) -> List[Tuple[int, int]]:
+    """
+    人声区间（采样点 [start, end)）：短于 min_silence_ms 的静音并入前后人声，
+    短于 min_speech_ms 的人声丢弃，每段两端各扩 pad_ms，重叠的合并
+    """
+    mask = frame_speech_mask(x, sr, frame_ms)
+    if not mask.any():
+        return []
+    frame = int(sr * frame_ms / 1000)
+
+    # 填平短静音：相邻人声段之间的空隙小于阈值就连起来
+    starts, ends = _runs(mask)
+    gaps = starts[1:] - ends[:-1]
+    short = np.flatnonzero(gaps * frame_ms < min_silence_ms)
+    for i in short:
+        mask[ends[i]:starts[i + 1]] = True
+
+    starts, ends = _runs(mask)
+    keep = (ends - starts) * frame_ms >= min_speech_ms
+    starts, ends = starts[keep], ends[keep]
+    if starts.size == 0:
+        return []
+
+    pad = int(sr * pad_ms / 1000)
+    starts = np.maximum(starts * frame - pad, 0)
+    ends = np.minimum(ends * frame + pad, x.size)
+
+    segments: List[Tuple[int, int]] = []
+    for s, e in zip(starts.tolist(), ends.tolist()):
+        if segments and s <= segments[-1][1]:
+            segments[-1] = (segments[-1][0], e)
+        else:
+            segments.append((s, e))
+    return segments
@@ -0,0 +1,156 @@
+# admission.py
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional, Tuple
+
+
+class AdmissionRejected(Exception):
+    """
+    请求被准入控制拒绝
+    status_code  429=用户限流；503=上游过载
+    code         RATE_LIMITED / OVERLOADED，用于 WebSocket error 帧
+    retry_after  建议多少秒后重试
+    """
+    def __init__(self, status_code: int, code: str, message: str, retry_after: float):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class _Slots:
+    """单个上游的并发槽位：active 个在跑，waiting 个在排队"""
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.sem = asyncio.Semaphore(limit) if limit > 0 else None
+        self.active = 0
+        self.waiting = 0
+
+
+class Admission:
+    """
+    LLM 请求准入控制：
+    - 每个用户一个令牌桶：rate_per_min 个/分钟，最多攒 burst 个；用完直接 429（acquire_user 可等待到期限）
+    - 每个上游一个并发上限 limits[upstream]；满了排队，排队超过 queue_timeout_s 或队列已有 max_queue 个就 503
+    上限 <= 0 表示不限制
+    """
+    def __init__(self,
+                 rate_per_min: float = 30.0,
+                 burst: int = 10,
+                 limits: Optional[Dict[str, int]] = None,
+                 queue_timeout_s: float = 5.0,
+                 max_queue: int = 64,
+                 max_users: int = 10000):
+        self.rate = rate_per_min / 60.0
+        self.burst = burst
+        self.queue_timeout_s = queue_timeout_s
+        self.max_queue = max_queue
+        self.max_users = max_users
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()  # user -> (tokens, 上次更新时间)
+        self._slots: Dict[str, _Slots] = {name: _Slots(n) for name, n in (limits or {}).items()}
+        self.rejections: Dict[str, int] = {"rate_limited": 0, "overloaded": 0}
+
+    def _take(self, user: str) -> float:
+        """尝试消耗该用户一个令牌：成功返回 0，否则返回还要等多少秒才有令牌"""
+        now = time.monotonic()
+        tokens, last = self._buckets.pop(user, (float(self.burst), now))
+        tokens = min(float(self.burst), tokens + (now - last) * self.rate)
+        if tokens < 1.0:
+            self._buckets[user] = (tokens, now)
+            return (1.0 - tokens) / self.rate
+        self._buckets[user] = (tokens - 1.0, now)
+        while len(self._buckets) > self.max_users:
+            self._buckets.popitem(last=False)
+        return 0.0
+
+    def check_user(self, user: str) -> None:
+        """消耗该用户一个令牌，没有令牌时抛 429"""
+        if self.rate <= 0:
+            return
+        wait = self._take(user)
+        if wait > 0:
+            self.rejections["rate_limited"] += 1
+            raise AdmissionRejected(429, "RATE_LIMITED", "too many requests", wait)
+
+    async def acquire_user(self, user: str, timeout_s: float) -> None:
+        """消耗该用户一个令牌，没有令牌时排队等待；timeout_s 内等不到则抛 429"""
+        if self.rate <= 0:
+            return
+        deadline = time.monotonic() + timeout_s
+        while True:
+            wait = self._take(user)
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > deadline:
+                self.rejections["rate_limited"] += 1
+                raise AdmissionRejected(429, "RATE_LIMITED", "too many requests", wait)
+            await asyncio.sleep(wait)
+
+    def check_capacity(self, upstream: str) -> None:
+        """不等待，只判断排队是否已满；用于在返回流式响应前快速拒绝"""
+        slots = self._slots.get(upstream)
+        if slots is None or slots.sem is None:
+            return
+        if slots.active >= slots.limit and slots.waiting >= self.max_queue:
+            self.rejections["overloaded"] += 1
+            raise AdmissionRejected(503, "OVERLOADED", f"{upstream} is overloaded", self.queue_timeout_s)
+
+    @asynccontextmanager
+    async def slot(self, upstream: str):
+        """占用一个上游并发槽位；排队超时或队列已满时抛 503"""
+        slots = self._slots.get(upstream)
+        if slots is None or slots.sem is None:
+            yield
+            return
+        self.check_capacity(upstream)
+        slots.waiting += 1
+        try:
+            await asyncio.wait_for(slots.sem.acquire(), self.queue_timeout_s)
+        except asyncio.TimeoutError:
+            self.rejections["overloaded"] += 1
+            raise AdmissionRejected(503, "OVERLOADED", f"{upstream} is overloaded", self.queue_timeout_s)
+        finally:
+            slots.waiting -= 1
+        slots.active += 1
+        try:
+            yield
+        finally:
+            slots.active -= 1
+            slots.sem.release()
+
+    def guard(self, upstream: str, stream: Any) -> "GuardedStream":
+        return GuardedStream(self, upstream, stream)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rejections": dict(self.rejections),
+            "upstreams": {name: {"limit": s.limit, "active": s.active, "waiting": s.waiting}
+                          for name, s in self._slots.items()},
+        }
+
+
+class GuardedStream:
+    """
+    给上游流加并发槽位：开始迭代时排队拿槽位，流结束（或被取消）时释放
+    接口与被包装的流相同（async for / result / connect_s）
+    """
+    def __init__(self, admission: Admission, upstream: str, stream: Any):
+        self.admission = admission
+        self.upstream = upstream
+        self.stream = stream
+
+    @property
+    def result(self) -> Dict[str, Any]:
+        return self.stream.result
+
+    @property
+    def connect_s(self) -> Optional[float]:
+        return self.stream.connect_s
+
+    async def __aiter__(self):
+        async with self.admission.slot(self.upstream):
+            async for delta in self.stream:
+                yield delta
@@ -0,0 +1,174 @@
+# answer_cache.py
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+_SPACES = re.compile(r"\s+")
+_TRAILING_PUNCT = "?？!！。.,，;；~～ "
+
+
+def normalize_query(query: str) -> str:
+    """
+    归一化问题文本，让写法略有差异的同一问题命中同一条缓存：
+    全角转半角（NFKC）、去首尾空白、合并空白、英文小写、去掉句末标点
+    """
+    q = unicodedata.normalize("NFKC", query).strip().lower()
+    q = _SPACES.sub(" ", q)
+    return q.rstrip(_TRAILING_PUNCT)
+
+
+class AnswerCache:
+    """
+    RAG 答案缓存：key = (model_choice, 归一化问题)
+    - 容量超过 max_size 时按 LRU 淘汰，每条缓存 ttl_s 秒后过期
+    - 配置了 path 时可以 load()/save() 到 JSON 文件，重启后继续命中
+    """
+    def __init__(self, max_size: int = 1000, ttl_s: float = 3600.0, path: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self.path = path
+        self._data: "OrderedDict[Tuple[str, str], Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_s > 0 and self.max_size > 0
+
+    @staticmethod
+    def _key(query: str, model: str) -> Tuple[str, str]:
+        return model, normalize_query(query)
+
+    def get(self, query: str, model: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        key = self._key(query, model)
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] <= time.time():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, query: str, model: str, answer: str) -> None:
+        if not self.enabled or not answer:
+            return
+        key = self._key(query, model)
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl_s, answer)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, model: Optional[str] = None) -> int:
+        """清空缓存（知识图谱更新后调用）；指定 model 时只清该模型的条目，返回清掉的条数"""
+        with self._lock:
+            if model is None:
+                n = len(self._data)
+                self._data.clear()
+            else:
+                keys = [k for k in self._data if k[0] == model]
+                for k in keys:
+                    del self._data[k]
+                n = len(keys)
+        if self.path:
+            self.save()
+        return n
+
+    def load(self) -> int:
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        with open(self.path, "r", encoding="utf-8") as f:
+            rows = json.load(f)
+        now = time.time()
+        with self._lock:
+            for model, query, expires, answer in rows:
+                if expires > now:
+                    self._data[(model, query)] = (expires, answer)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            return len(self._data)
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            rows = [[m, q, exp, ans] for (m, q), (exp, ans) in self._data.items()]
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False)
+        os.replace(tmp, self.path)  # 原子替换，避免写一半的文件
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits / total) if total else 0.0,
+        }
+
+
+class CachingStream:
+    """
+    给上游流加一层答案缓存，对外接口与 OllamaStream 相同（async for / result / connect_s）：
+    - 命中：把缓存答案按 chunk_chars 切块快速回放，不访问上游
+    - 未命中：透传上游增量，完整结束后写入缓存（中途失败或取消不写）
+    - cacheable(result) 返回 False 时也不写（比如答案来自别的后端）
+    - 可以在迭代前调用 lookup() 提前查缓存（比如命中时不做限流），迭代时不会再查第二次
+    """
+    def __init__(self, cache: AnswerCache, query: str, model: str,
+                 factory: Callable[[], Any], chunk_chars: int = 16,
+                 cacheable: Optional[Callable[[Dict[str, Any]], bool]] = None):
+        self.cache = cache
+        self.query = query
+        self.model = model
+        self.factory = factory
+        self.chunk_chars = max(chunk_chars, 1)
+        self.cacheable = cacheable
+        self.result: Dict[str, Any] = {"finish_reason": None, "usage": None}
+        self.connect_s: Optional[float] = None
+        self.cached = False
+        self._looked_up = False
+        self._answer: Optional[str] = None
+
+    def lookup(self) -> bool:
+        """查一次缓存并记住结果，返回是否命中"""
+        if not self._looked_up:
+            self._looked_up = True
+            self._answer = self.cache.get(self.query, self.model)
+            self.cached = self._answer is not None
+        return self.cached
+
+    async def __aiter__(self):
+        self.lookup()
+        answer, self._answer = self._answer, None
+        if answer is not None:
+            self.connect_s = 0.0
+            for i in range(0, len(answer), self.chunk_chars):
+                yield answer[i:i + self.chunk_chars]
+            self.result = {"finish_reason": "stop", "usage": None}
+            return
+
+        upstream = self.factory()
+        parts = []
+        try:
+            async for delta in upstream:
+                parts.append(delta)
+                yield delta
+        finally:
+            self.connect_s = upstream.connect_s
+        self.result = upstream.result
+        if self.cacheable is None or self.cacheable(self.result):
+            self.cache.put(self.query, self.model, "".join(parts))
@@ -0,0 +1,95 @@
+# auth_cache.py
+import base64
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+def token_key(token: str) -> str:
+    """缓存键：token 的 sha256，避免把明文 token 长期放在内存字典里"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def token_exp(token: str) -> Optional[float]:
+    """
+    不验签，只解析 JWT payload 里的 exp（秒级时间戳）
+    解析失败返回 None，由调用方退回到最大 TTL
+    """
+    try:
+        payload_b64 = token.split(".")[1]
+        payload_b64 += "=" * (-len(payload_b64) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(payload_b64))
+        exp = payload.get("exp")
+        return float(exp) if exp is not None else None
+    except Exception:
+        return None
+
+
+class AuthCache:
+    """
+    JWT 验证结果的进程内 TTL 缓存：
+    - 正结果：过期时间 = min(token 的 exp, now + max_ttl)
+    - 负结果（token 无效）：只缓存 neg_ttl 秒，避免一直拒绝刚修好的 token
+    - 超过 max_size 时按 LRU 淘汰
+    """
+    def __init__(self, max_ttl: float = 60.0, neg_ttl: float = 5.0, max_size: int = 10000):
+        self.max_ttl = max_ttl
+        self.neg_ttl = neg_ttl
+        self.max_size = max_size
+        self._data: "OrderedDict[str, Tuple[float, bool, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[Tuple[bool, Dict[str, Any]]]:
+        """
+        命中返回 (valid, data)，未命中或已过期返回 None
+        """
+        key = token_key(token)
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] <= now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1], item[2]
+
+    def put(self, token: str, valid: bool, data: Optional[Dict[str, Any]] = None) -> None:
+        if self.max_ttl <= 0:
+            return
+        now = time.time()
+        if valid:
+            expires = now + self.max_ttl
+            exp = token_exp(token)
+            if exp is not None:
+                expires = min(expires, exp)
+        else:
+            expires = now + self.neg_ttl
+        if expires <= now:
+            return
+        key = token_key(token)
+        with self._lock:
+            self._data[key] = (expires, valid, data or {})
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits / total) if total else 0.0,
+        }
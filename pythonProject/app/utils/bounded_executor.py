@@ -0,0 +1,97 @@
+# bounded_executor.py
+import asyncio
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+
+class ExecutorSaturated(Exception):
+    """工作线程和等待队列都已占满，调用方应返回 503"""
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is overloaded")
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class BoundedExecutor:
+    """
+    专用的定长线程池，用于把 CPU 密集的同步任务（模型推理等）移出事件循环：
+    - 最多 max_workers 个任务同时执行，最多 max_queue 个排队，再多直接抛 ExecutorSaturated
+    - on_wait(秒) / on_run(秒) 在事件循环线程回调排队耗时和执行耗时，用于指标
+    - 调用方取消时，尚未开始执行的任务会从队列里撤掉
+    """
+    def __init__(self,
+                 max_workers: int = 1,
+                 max_queue: int = 8,
+                 name: str = "worker",
+                 on_wait: Optional[Callable[[float], None]] = None,
+                 on_run: Optional[Callable[[float], None]] = None):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._on_wait = on_wait
+        self._on_run = on_run
+        self._avg_run_s = 0.0
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.completed = 0
+
+    def _retry_after(self) -> float:
+        # 粗略估计：排在前面的任务全部跑完所需时间
+        return self._avg_run_s * (self.waiting + 1) / self.max_workers
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            if self.active + self.waiting >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise ExecutorSaturated(self.name, self._retry_after())
+            self.waiting += 1
+        submitted = time.perf_counter()
+        timing: Dict[str, float] = {}
+
+        def call():
+            started = time.perf_counter()
+            with self._lock:
+                self.waiting -= 1
+                self.active += 1
+            timing["wait"] = started - submitted
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timing["run"] = time.perf_counter() - started
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        cf = self._pool.submit(call)
+        try:
+            return await asyncio.wrap_future(cf)
+        except asyncio.CancelledError:
+            if cf.cancel():  # 还没开始执行：撤出队列
+                with self._lock:
+                    self.waiting -= 1
+            raise
+        finally:
+            if "wait" in timing and self._on_wait:
+                self._on_wait(timing["wait"])
+            if "run" in timing:
+                self._avg_run_s = 0.8 * self._avg_run_s + 0.2 * timing["run"] if self._avg_run_s else timing["run"]
+                if self._on_run:
+                    self._on_run(timing["run"])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "completed": self.completed,
+        }
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,54 @@
+# http_pool.py
+import os
+from typing import Dict
+
+import httpx
+
+
+def _env(prefix: str, name: str, default: str) -> str:
+    """先读 <PREFIX>_<NAME>，没有再读全局 HTTP_<NAME>"""
+    return os.getenv(f"{prefix}_{name}", os.getenv(f"HTTP_{name}", default))
+
+
+def build_client(prefix: str, default_timeout: float) -> httpx.AsyncClient:
+    """
+    按上游名字构建一个长连接池：
+    <PREFIX>_MAX_CONNECTIONS      最大连接数
+    <PREFIX>_MAX_KEEPALIVE        最大空闲 keep-alive 连接数
+    <PREFIX>_KEEPALIVE_EXPIRY_S   空闲连接保留时间
+    <PREFIX>_TIMEOUT_S            读/写/池等待超时
+    <PREFIX>_CONNECT_TIMEOUT_S    建连超时
+    每一项都可以用 HTTP_<NAME> 给所有上游设默认值
+    """
+    timeout_s = float(_env(prefix, "TIMEOUT_S", str(default_timeout)))
+    connect_s = float(_env(prefix, "CONNECT_TIMEOUT_S", str(min(timeout_s, 5.0))))
+    limits = httpx.Limits(
+        max_connections=int(_env(prefix, "MAX_CONNECTIONS", "200")),
+        max_keepalive_connections=int(_env(prefix, "MAX_KEEPALIVE", "50")),
+        keepalive_expiry=float(_env(prefix, "KEEPALIVE_EXPIRY_S", "30")),
+    )
+    return httpx.AsyncClient(timeout=httpx.Timeout(timeout_s, connect=connect_s), limits=limits)
+
+
+class HttpPools:
+    """
+    应用级的上游连接池集合，startup 时创建，shutdown 时统一关闭
+    """
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def open(self, name: str, prefix: str, default_timeout: float) -> httpx.AsyncClient:
+        client = build_client(prefix, default_timeout)
+        self._clients[name] = client
+        return client
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        client = self._clients.get(name)
+        if client is None:
+            raise RuntimeError(f"http client '{name}' 未初始化")
+        return client
+
+    async def aclose(self) -> None:
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
@@ -0,0 +1,89 @@
+# jwt_local.py
+import json
+from typing import Any, Dict, Optional
+
+try:
+    import jwt  # PyJWT（RS256 需要额外安装 cryptography）
+except Exception:  # 可选依赖，没装时只能走远程验证
+    jwt = None
+
+
+class LocalJWTError(Exception):
+    """token 本地验证不通过（签名错误、过期、未生效等）"""
+
+
+class LocalKeyUnavailable(LocalJWTError):
+    """本地没有能验证这个 token 的密钥（例如 JWKS 里找不到 kid），可以退回远程验证"""
+
+
+class LocalJWTVerifier:
+    """
+    本地 JWT 验签：
+    - HS256：共享密钥 secret
+    - RS256：PEM 公钥文件 或 JWKS 文件（按 header 里的 kid 选公钥）
+    - 校验 exp / nbf（允许 leeway 秒的时钟误差）
+    """
+    def __init__(self,
+                 algorithm: str = "HS256",
+                 secret: Optional[str] = None,
+                 public_key_path: Optional[str] = None,
+                 jwks_path: Optional[str] = None,
+                 leeway: float = 0.0,
+                 audience: Optional[str] = None,
+                 issuer: Optional[str] = None):
+        if jwt is None:
+            raise RuntimeError("本地验签需要安装 PyJWT（RS256 还需要 cryptography）")
+        self.algorithm = algorithm.upper()
+        self.leeway = leeway
+        self.audience = audience
+        self.issuer = issuer
+        self._key = None
+        self._jwks: Dict[str, Any] = {}
+
+        if self.algorithm.startswith("HS"):
+            if not secret:
+                raise ValueError(f"{self.algorithm} 需要配置共享密钥")
+            self._key = secret
+        elif jwks_path:
+            with open(jwks_path, "r", encoding="utf-8") as f:
+                jwk_set = jwt.PyJWKSet.from_dict(json.load(f))
+            self._jwks = {k.key_id: k.key for k in jwk_set.keys}
+            if len(self._jwks) == 1:
+                self._key = next(iter(self._jwks.values()))  # 只有一把公钥时不要求 kid
+        elif public_key_path:
+            with open(public_key_path, "r", encoding="utf-8") as f:
+                self._key = f.read()
+        else:
+            raise ValueError(f"{self.algorithm} 需要配置公钥文件或 JWKS 文件")
+
+    def _select_key(self, token: str):
+        if not self._jwks:
+            return self._key
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+        except jwt.InvalidTokenError as e:
+            raise LocalJWTError(f"bad header: {e}") from e
+        key = self._jwks.get(kid) if kid else self._key
+        if key is None:
+            raise LocalKeyUnavailable(f"unknown kid: {kid}")
+        return key
+
+    def verify(self, token: str) -> Dict[str, Any]:
+        """
+        验证通过返回与远程接口相同风格的数据：{"valid": True, "username": ..., **claims}
+        """
+        key = self._select_key(token)
+        try:
+            claims = jwt.decode(
+                token,
+                key,
+                algorithms=[self.algorithm],
+                leeway=self.leeway,
+                audience=self.audience,
+                issuer=self.issuer,
+                options={"require": ["exp"], "verify_aud": self.audience is not None},
+            )
+        except jwt.InvalidTokenError as e:  # 包含过期、未生效、签名错误
+            raise LocalJWTError(str(e)) from e
+        username = claims.get("username") or claims.get("sub")
+        return {**claims, "valid": True, "username": username}
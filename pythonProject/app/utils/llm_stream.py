@@ -0,0 +1,63 @@
+# llm_stream.py
+import json
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+
+class UpstreamError(Exception):
+    """上游 LLM 服务返回非 200"""
+    def __init__(self, status_code: int):
+        super().__init__(f"External RAG service error: {status_code}")
+        self.status_code = status_code
+
+
+class OllamaStream:
+    """
+    Ollama /api/generate 流式调用封装：
+    - async for 逐个取文本增量（delta）
+    - 正常结束后 result 里有 finish_reason / usage，connect_s 为建连到响应头的耗时
+    - 所在任务被取消时，client.stream 的上下文会关闭上游连接，Ollama 随之停止生成
+    """
+    def __init__(self, client: httpx.AsyncClient, url: str, model: str, prompt: str):
+        self.client = client
+        self.url = url
+        self.payload = {"model": model, "prompt": prompt, "stream": True}
+        self.result: Dict[str, Any] = {"finish_reason": None, "usage": None}
+        self.connect_s: Optional[float] = None  # 发起请求到收到响应头的耗时
+
+    async def __aiter__(self):
+        t0 = time.perf_counter()
+        async with self.client.stream("POST", self.url, json=self.payload) as response:
+            self.connect_s = time.perf_counter() - t0
+            if response.status_code != 200:
+                raise UpstreamError(response.status_code)
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                delta = data.get("response")
+                if delta:
+                    yield delta
+                if data.get("done"):
+                    self.result = {
+                        "finish_reason": data.get("done_reason", "stop"),
+                        "usage": _ollama_usage(data),
+                    }
+
+
+def _ollama_usage(data: Dict[str, Any]) -> Optional[Dict[str, int]]:
+    """Ollama 最后一帧里的 prompt_eval_count / eval_count 转成 OpenAI 风格的 usage"""
+    if "eval_count" not in data:
+        return None
+    prompt_tokens = int(data.get("prompt_eval_count", 0))
+    completion_tokens = int(data.get("eval_count", 0))
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
@@ -0,0 +1,181 @@
+# metrics.py
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# 时间类直方图的默认分桶（秒）
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2000, 4000)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _fmt_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def _fmt_value(v: float) -> str:
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, v in self._values.items():
+                lines.append(f"{self.name}{_fmt_labels(key)} {_fmt_value(v)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # label -> (各桶计数, sum, count)
+        self._values: Dict[LabelKey, Tuple[List[int], float, int]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, n = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value, n + 1)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, n) in self._values.items():
+                cumulative = 0
+                for upper, c in zip(self.buckets, counts):
+                    cumulative += c
+                    lines.append(f"{self.name}_bucket{_fmt_labels(key, ('le', _fmt_value(upper)))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_fmt_labels(key, ('le', '+Inf'))} {n}")
+                lines.append(f"{self.name}_sum{_fmt_labels(key)} {total!r}")
+                lines.append(f"{self.name}_count{_fmt_labels(key)} {n}")
+        return lines
+
+
+class Registry:
+    """
+    极简的 Prometheus 文本格式指标注册表（不依赖 prometheus_client）
+    gauge 用回调在抓取时取值，便于把已有的统计字典直接暴露出来
+    """
+    def __init__(self):
+        self._metrics: List = []
+        self._gauges: List[Tuple[str, str, Callable[[], Dict[LabelKey, float]]]] = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        m = Counter(name, help)
+        self._metrics.append(m)
+        return m
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = TIME_BUCKETS) -> Histogram:
+        m = Histogram(name, help, buckets)
+        self._metrics.append(m)
+        return m
+
+    def gauge_fn(self, name: str, help: str, fn: Callable[[], float]) -> None:
+        self._gauges.append((name, help, lambda: {(): fn()}))
+
+    def gauge_map(self, name: str, help: str, label: str, fn: Callable[[], Dict[str, float]]) -> None:
+        """fn 返回 {label 值: 数值}"""
+        self._gauges.append((name, help, lambda: {((label, k),): v for k, v in fn().items()}))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        for name, help, fn in self._gauges:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for key, v in fn().items():
+                lines.append(f"{name}{_fmt_labels(key)} {_fmt_value(v)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+WS_AUTH_SECONDS = REGISTRY.histogram("ws_handshake_auth_seconds", "WebSocket 握手鉴权耗时")
+LLM_CONNECT_SECONDS = REGISTRY.histogram("llm_upstream_connect_seconds", "上游 LLM 建连到响应头的耗时")
+LLM_TTFT_SECONDS = REGISTRY.histogram("llm_time_to_first_token_seconds", "请求开始到第一个增量的耗时")
+LLM_GAP_SECONDS = REGISTRY.histogram("llm_inter_token_gap_seconds", "相邻增量之间的间隔",
+                                     (0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0))
+LLM_TOKENS = REGISTRY.histogram("llm_stream_tokens", "单次流式输出的 token 数", COUNT_BUCKETS)
+LLM_DURATION_SECONDS = REGISTRY.histogram("llm_stream_duration_seconds", "单次流式输出总耗时")
+LLM_TOKENS_PER_SECOND = REGISTRY.histogram("llm_tokens_per_second", "首 token 之后的输出速率", RATE_BUCKETS)
+ANTI_SPOOF_QUEUE_WAIT_SECONDS = REGISTRY.histogram("anti_spoof_queue_wait_seconds", "反欺诈推理在队列中的等待耗时")
+ANTI_SPOOF_INFER_SECONDS = REGISTRY.histogram("anti_spoof_infer_seconds", "反欺诈推理（解码+预处理+模型）耗时")
+
+
+class StreamTimer:
+    """
+    单个 request_id 的流式计时：
+    - wrap(source) 包住上游增量流，记录首个增量时间和相邻增量间隔
+    - finish() 把结果写进直方图，并返回给 result 帧用的 timing
+    """
+    def __init__(self, **labels: str):
+        self.labels = labels
+        self.start = time.perf_counter()
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+        self.tokens = 0
+        self.connect_s: Optional[float] = None
+
+    async def wrap(self, source):
+        async for delta in source:
+            now = time.perf_counter()
+            if self.first is None:
+                self.first = now
+            else:
+                LLM_GAP_SECONDS.observe(now - self.last, **self.labels)
+            self.last = now
+            self.tokens += 1
+            yield delta
+
+    def finish(self, completion_tokens: Optional[int] = None) -> Dict[str, Optional[float]]:
+        end = time.perf_counter()
+        tokens = completion_tokens if completion_tokens is not None else self.tokens
+        duration = end - self.start
+        ttft = (self.first - self.start) if self.first is not None else None
+        rate = None
+        if self.first is not None and end > self.first and tokens > 1:
+            rate = (tokens - 1) / (end - self.first)
+
+        LLM_DURATION_SECONDS.observe(duration, **self.labels)
+        LLM_TOKENS.observe(tokens, **self.labels)
+        if ttft is not None:
+            LLM_TTFT_SECONDS.observe(ttft, **self.labels)
+        if rate is not None:
+            LLM_TOKENS_PER_SECOND.observe(rate, **self.labels)
+        if self.connect_s is not None:
+            LLM_CONNECT_SECONDS.observe(self.connect_s, **self.labels)
+
+        def ms(v):
+            return round(v * 1000, 1) if v is not None else None
+
+        return {
+            "connect_ms": ms(self.connect_s),
+            "ttft_ms": ms(ttft),
+            "duration_ms": ms(duration),
+            "tokens_per_s": round(rate, 2) if rate is not None else None,
+        }
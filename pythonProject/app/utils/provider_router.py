@@ -0,0 +1,186 @@
+# provider_router.py
+import asyncio
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+
+class _BackendStats:
+    """单个后端最近 window_s 秒内的结果：(时间, 首 token 耗时 或 None, 是否成功)"""
+    def __init__(self):
+        self.samples: Deque[Tuple[float, Optional[float], bool]] = deque(maxlen=1000)
+        self.served = 0      # 最终由该后端输出的请求数
+        self.hedge_wins = 0  # 其中由对冲请求抢到首 token 的次数
+
+    def prune(self, now: float, window_s: float) -> None:
+        while self.samples and now - self.samples[0][0] > window_s:
+            self.samples.popleft()
+
+    def ttft(self) -> Optional[float]:
+        values = [t for _, t, ok in self.samples if ok and t is not None]
+        return sum(values) / len(values) if values else None
+
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, _, ok in self.samples if not ok) / len(self.samples)
+
+
+class ProviderRouter:
+    """
+    多个 LLM 后端之间按延迟选路 + 故障转移：
+    - 记录每个后端最近 window_s 秒的首 token 耗时和错误率
+    - 健康（样本不足 min_samples 或错误率不超过 max_error_rate）的后端按平均首 token 耗时排序，
+      没有样本的按 backends 配置顺序排在有样本的之后；不健康的排最后，只做兜底
+    - 主后端出首 token 之前失败，按顺序换下一个；配置了 hedge_after_s 时，
+      主后端超过该时间还没出首 token 就并行发起备用请求，谁先出 token 用谁，另一个取消
+    - 出首 token 之后不再切换
+    """
+    def __init__(self,
+                 backends: List[str],
+                 window_s: float = 60.0,
+                 max_error_rate: float = 0.5,
+                 min_samples: int = 5,
+                 hedge_after_s: float = 0.0,
+                 on_route: Optional[Callable[[str, str], None]] = None):
+        self.backends = list(backends)
+        self.window_s = window_s
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.hedge_after_s = hedge_after_s
+        self._stats: Dict[str, _BackendStats] = {b: _BackendStats() for b in self.backends}
+        self._on_route = on_route  # 回调 (backend, reason)，reason: primary / failover / hedge
+
+    def record(self, backend: str, ttft_s: Optional[float], ok: bool) -> None:
+        stats = self._stats.setdefault(backend, _BackendStats())
+        stats.samples.append((time.monotonic(), ttft_s, ok))
+
+    def healthy(self, backend: str) -> bool:
+        stats = self._stats[backend]
+        stats.prune(time.monotonic(), self.window_s)
+        return len(stats.samples) < self.min_samples or stats.error_rate() <= self.max_error_rate
+
+    def rank(self, candidates: Optional[List[str]] = None) -> List[str]:
+        candidates = [b for b in self.backends if candidates is None or b in candidates]
+
+        def key(item):
+            pos, b = item
+            ttft = self._stats[b].ttft()
+            return (not self.healthy(b), ttft is None, ttft or 0.0, pos)
+
+        return [b for _, b in sorted(enumerate(candidates), key=key)]
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        out = {}
+        for b in self.backends:
+            healthy = self.healthy(b)
+            s = self._stats[b]
+            out[b] = {"healthy": healthy, "ttft_s": s.ttft(), "error_rate": s.error_rate(),
+                      "samples": len(s.samples), "served": s.served, "hedge_wins": s.hedge_wins}
+        return out
+
+    def stream(self, factories: Dict[str, Callable[[], Any]]) -> "RoutedStream":
+        return RoutedStream(self, factories)
+
+    def _routed(self, backend: str, reason: str) -> None:
+        if self._on_route:
+            self._on_route(backend, reason)
+
+    def _served(self, backend: str, reason: str) -> None:
+        stats = self._stats[backend]
+        stats.served += 1
+        if reason == "hedge":
+            stats.hedge_wins += 1
+
+
+class RoutedStream:
+    """
+    经路由选择后的流，接口与 OllamaStream 相同（async for / result / connect_s）
+    backend 为最终提供输出的后端
+    """
+    def __init__(self, router: ProviderRouter, factories: Dict[str, Callable[[], Any]]):
+        self.router = router
+        self.factories = factories
+        self.result: Dict[str, Any] = {"finish_reason": None, "usage": None}
+        self.connect_s: Optional[float] = None
+        self.backend: Optional[str] = None
+
+    async def __aiter__(self):
+        router = self.router
+        pending = router.rank(list(self.factories))
+        if not pending:
+            raise RuntimeError("no LLM backend available")
+
+        # 正在抢首 token 的请求：task(取第一个增量) -> (后端名, 发起原因, 流, 迭代器, 开始时间)
+        racers: Dict[asyncio.Task, Tuple[str, str, Any, Any, float]] = {}
+
+        def launch(reason: str) -> None:
+            name = pending.pop(0)
+            stream = self.factories[name]()
+            it = stream.__aiter__()
+            racers[asyncio.create_task(it.__anext__())] = (name, reason, stream, it, time.perf_counter())
+            router._routed(name, reason)
+
+        launch("primary")
+        hedged = False
+        winner = None
+        last_error: Optional[BaseException] = None
+        try:
+            while winner is None:
+                if not racers:
+                    if not pending:
+                        raise last_error or RuntimeError("all LLM backends failed")
+                    launch("failover")
+                    continue
+                timeout = None
+                if router.hedge_after_s > 0 and not hedged and pending:
+                    timeout = router.hedge_after_s
+                done, _ = await asyncio.wait(list(racers), timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    launch("hedge")
+                    continue
+                for task in done:
+                    name, reason, stream, it, t0 = racers.pop(task)
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        first = None  # 空输出也算成功
+                    except Exception as e:
+                        router.record(name, None, False)
+                        last_error = e
+                        continue
+                    router.record(name, time.perf_counter() - t0, True)
+                    router._served(name, reason)
+                    winner = (name, stream, it, first)
+                    break
+        finally:
+            # 输掉的请求全部取消，关闭其上游连接
+            for task in racers:
+                task.cancel()
+            if racers:
+                await asyncio.gather(*racers, return_exceptions=True)
+                for _, _, _, it, _ in racers.values():
+                    try:
+                        await it.aclose()
+                    except BaseException:
+                        pass
+
+        name, stream, it, first = winner
+        self.backend = name
+        try:
+            if first is None:
+                return
+            yield first
+            async for delta in it:
+                yield delta
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            router.record(name, None, False)
+            raise
+        finally:
+            self.result = {**stream.result, "backend": name}  # 调用方据此判断答案来自哪个后端
+            self.connect_s = stream.connect_s
+            await it.aclose()
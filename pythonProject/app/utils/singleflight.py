@@ -0,0 +1,96 @@
+# singleflight.py
+import asyncio
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from .stream_buffer import StreamBuffer
+
+
+class _Flight:
+    __slots__ = ("upstream", "buffer", "task", "subscribers")
+
+    def __init__(self, upstream: Any):
+        self.upstream = upstream
+        self.buffer = StreamBuffer()  # 不限长度：后来者要从头补齐
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers = 0
+
+
+class SingleFlight:
+    """
+    相同 key（归一化问题 + 模型）的并发流式请求只向上游发一次：
+    - 第一个请求创建上游流，由后台任务写入共享缓冲
+    - 之后相同 key 的请求订阅同一缓冲，先补齐已产生的增量再跟随实时输出
+    - 所有订阅者都离开时取消上游；流结束后 key 释放，新请求重新发起
+    """
+    def __init__(self, on_join: Optional[Callable[[bool], None]] = None):
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._on_join = on_join  # 回调参数：是否为发起者，用于统计
+
+    def stream(self, key: Hashable, factory: Callable[[], Any]) -> "FlightStream":
+        return FlightStream(self, key, factory)
+
+    def _join(self, key: Hashable, factory: Callable[[], Any]) -> "tuple[_Flight, bool]":
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight(factory())
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._pump(key, flight))
+        flight.subscribers += 1
+        if self._on_join:
+            self._on_join(leader)
+        return flight, leader
+
+    def _leave(self, key: Hashable, flight: _Flight) -> None:
+        flight.subscribers -= 1
+        if flight.subscribers <= 0 and not flight.task.done():
+            self._release(key, flight)  # 先摘掉，避免新请求加入一个正在取消的流
+            flight.task.cancel()
+
+    def _release(self, key: Hashable, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def _pump(self, key: Hashable, flight: _Flight) -> None:
+        try:
+            async for delta in flight.upstream:
+                flight.buffer.publish(delta)
+        except asyncio.CancelledError:
+            flight.buffer.close(error=RuntimeError("upstream cancelled"))
+            raise
+        except Exception as e:
+            flight.buffer.close(error=e)
+        else:
+            flight.buffer.close(result=flight.upstream.result)
+        finally:
+            self._release(key, flight)
+
+    def inflight(self) -> int:
+        return len(self._flights)
+
+
+class FlightStream:
+    """
+    单个请求看到的流，接口与 OllamaStream 相同（async for / result / connect_s）
+    shared 为 True 表示复用了别人发起的上游流
+    """
+    def __init__(self, group: SingleFlight, key: Hashable, factory: Callable[[], Any]):
+        self.group = group
+        self.key = key
+        self.factory = factory
+        self.result: Dict[str, Any] = {"finish_reason": None, "usage": None}
+        self.connect_s: Optional[float] = None
+        self.shared = False
+
+    async def __aiter__(self):
+        flight, leader = self.group._join(self.key, self.factory)
+        self.shared = not leader
+        try:
+            async for _, delta in flight.buffer.subscribe(0):
+                yield delta
+            if flight.buffer.error is not None:
+                raise flight.buffer.error
+            self.result = dict(flight.buffer.result or {})
+        finally:
+            self.connect_s = getattr(flight.upstream, "connect_s", None)
+            self.group._leave(self.key, flight)
@@ -0,0 +1,173 @@
+# stream_buffer.py
+import asyncio
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, Hashable, Optional, Tuple
+
+
+class ResumeGap(Exception):
+    """要求的起始 index 已经被环形缓冲淘汰"""
+    def __init__(self, first_index: int):
+        super().__init__(f"frames before index {first_index} are no longer buffered")
+        self.first_index = first_index
+
+
+class StreamBuffer:
+    """
+    单个流的增量缓冲，一个生产者、任意多个订阅者：
+    - publish() 追加一段增量，index 从 0 递增
+    - maxlen 不为 None 时只保留最近 maxlen 段（环形缓冲）
+    - subscribe(from_index) 先补发缓冲里 >= from_index 的增量，再跟随实时增量，生产者结束后退出
+    - 结束时 result / error 供订阅者生成最终帧
+    """
+    def __init__(self, maxlen: Optional[int] = None):
+        self._items: Deque[str] = deque(maxlen=maxlen)
+        self._next_index = 0
+        self._changed = asyncio.Event()
+        self.done = False
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[BaseException] = None
+
+    @property
+    def first_index(self) -> int:
+        return self._next_index - len(self._items)
+
+    @property
+    def next_index(self) -> int:
+        return self._next_index
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, delta: str) -> int:
+        index = self._next_index
+        self._items.append(delta)
+        self._next_index += 1
+        self._notify()
+        return index
+
+    def close(self, result: Optional[Dict[str, Any]] = None, error: Optional[BaseException] = None) -> None:
+        if self.done:
+            return
+        self.done = True
+        self.result = result
+        self.error = error
+        self._notify()
+
+    async def subscribe(self, from_index: int = 0) -> AsyncIterator[Tuple[int, str]]:
+        i = from_index
+        while True:
+            changed = self._changed
+            first = self.first_index
+            if i < first:
+                raise ResumeGap(first)
+            while i < self._next_index:
+                yield i, self._items[i - self.first_index]
+                i += 1
+                if i < self.first_index:  # 订阅者太慢，被环形缓冲甩开
+                    raise ResumeGap(self.first_index)
+            if self.done:
+                return
+            await changed.wait()
+
+
+class _Entry:
+    __slots__ = ("buffer", "task", "subscribers", "expire_handle")
+
+    def __init__(self, buffer: StreamBuffer, task: asyncio.Task):
+        self.buffer = buffer
+        self.task = task
+        self.subscribers = 0
+        self.expire_handle: Optional[asyncio.TimerHandle] = None
+
+
+class StreamRegistry:
+    """
+    按 key 管理正在生成 / 刚生成完的流，用于断线续传：
+    - 生产任务与连接解耦；最后一个订阅者离开后，再等 grace_s 秒没人接回就取消生产任务
+    - 生产结束后缓冲再保留 retention_s 秒，供重连补发
+    """
+    def __init__(self, retention_s: float = 60.0, grace_s: float = 15.0):
+        self.retention_s = retention_s
+        self.grace_s = grace_s
+        self._entries: Dict[Hashable, _Entry] = {}
+
+    def get(self, key: Hashable) -> Optional[StreamBuffer]:
+        entry = self._entries.get(key)
+        return entry.buffer if entry else None
+
+    def running(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and not entry.task.done()
+
+    def start(self, key: Hashable, buffer: StreamBuffer, coro) -> asyncio.Task:
+        old = self._entries.pop(key, None)
+        if old and old.expire_handle:
+            old.expire_handle.cancel()
+        task = asyncio.create_task(coro)
+        entry = _Entry(buffer, task)
+        self._entries[key] = entry
+        task.add_done_callback(lambda t: self._on_done(key, entry))
+        return task
+
+    def cancel(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        if entry is None or entry.task.done():
+            return False
+        entry.task.cancel()
+        return True
+
+    def attach(self, key: Hashable) -> Optional[_Entry]:
+        """
+        订阅 key 当前对应的流；返回的句柄交给 detach，
+        这样同一 key 被新的生成替换后，旧订阅者离开也不会影响新的流
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        entry.subscribers += 1
+        if entry.expire_handle and not entry.task.done():
+            entry.expire_handle.cancel()  # 在宽限期内接回来了
+            entry.expire_handle = None
+        return entry
+
+    def detach(self, entry: Optional[_Entry]) -> None:
+        if entry is None:
+            return
+        entry.subscribers -= 1
+        if entry.subscribers > 0 or entry.task.done():
+            return
+        if self.grace_s <= 0:
+            entry.task.cancel()
+        else:
+            loop = asyncio.get_running_loop()
+            entry.expire_handle = loop.call_later(self.grace_s, self._abandon, entry)
+
+    @staticmethod
+    def _abandon(entry: _Entry) -> None:
+        entry.expire_handle = None
+        if entry.subscribers <= 0:
+            entry.task.cancel()
+
+    def _on_done(self, key: Hashable, entry: _Entry) -> None:
+        if self._entries.get(key) is not entry:
+            return
+        if entry.expire_handle:
+            entry.expire_handle.cancel()
+        if self.retention_s <= 0:
+            del self._entries[key]
+            return
+        loop = asyncio.get_running_loop()
+        entry.expire_handle = loop.call_later(self.retention_s, self._expire, key, entry)
+
+    def _expire(self, key: Hashable, entry: _Entry) -> None:
+        if self._entries.get(key) is entry:
+            del self._entries[key]
+
+    async def aclose(self) -> None:
+        """进程退出时取消所有生产任务"""
+        tasks = [e.task for e in self._entries.values() if not e.task.done()]
+        for t in tasks:
+            t.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,164 @@
+# stream_utils.py
+import asyncio
+import os
+from dataclasses import dataclass
+from typing import AsyncIterable, AsyncIterator, Mapping, Optional
+
+
+@dataclass(frozen=True)
+class CoalesceConfig:
+    """
+    增量合并参数：
+    window_ms  第一段增量进入缓冲后最多等多久就发送（0 表示不合并，来一段发一段）
+    max_bytes  缓冲的 UTF-8 字节数达到多少立即发送
+    """
+    window_ms: float = 20.0
+    max_bytes: int = 1024
+
+    @property
+    def enabled(self) -> bool:
+        return self.window_ms > 0
+
+
+MAX_COALESCE_WINDOW_MS = 1000.0  # 合并窗口上限，再大就不像流式输出了
+
+# 预设：latency 优先首字和逐字效果；throughput 优先减少帧数和 CPU
+COALESCE_PRESETS = {
+    "latency": CoalesceConfig(window_ms=0, max_bytes=0),
+    "balanced": CoalesceConfig(window_ms=20, max_bytes=1024),
+    "throughput": CoalesceConfig(window_ms=50, max_bytes=4096),
+}
+
+
+def coalesce_config(mode: Optional[str] = None,
+                    window_ms: Optional[str] = None,
+                    max_bytes: Optional[str] = None,
+                    env_prefix: str = "WS_COALESCE") -> CoalesceConfig:
+    """
+    组合出一份合并参数：显式参数 > 环境变量 <PREFIX>_MODE/_WINDOW_MS/_MAX_BYTES > 预设
+    window_ms / max_bytes 不是非负数（或超过上限）时抛 ValueError
+    """
+    mode = (mode or os.getenv(f"{env_prefix}_MODE", "balanced")).lower()
+    base = COALESCE_PRESETS.get(mode, COALESCE_PRESETS["balanced"])
+    window_ms = window_ms or os.getenv(f"{env_prefix}_WINDOW_MS")
+    max_bytes = max_bytes or os.getenv(f"{env_prefix}_MAX_BYTES")
+    cfg = CoalesceConfig(
+        window_ms=float(window_ms) if window_ms else base.window_ms,
+        max_bytes=int(max_bytes) if max_bytes else base.max_bytes,
+    )
+    if not 0 <= cfg.window_ms <= MAX_COALESCE_WINDOW_MS:  # 同时排除 nan / inf
+        raise ValueError(f"coalesce window_ms must be in [0, {MAX_COALESCE_WINDOW_MS}]: {window_ms}")
+    if cfg.max_bytes < 0:
+        raise ValueError(f"coalesce max_bytes must be >= 0: {max_bytes}")
+    return cfg
+
+
+def coalesce_config_from_query(params: Mapping[str, str], env_prefix: str = "WS_COALESCE") -> CoalesceConfig:
+    """WebSocket 握手参数 ?coalesce=latency|balanced|throughput&coalesce_ms=..&coalesce_bytes=..，非法时抛 ValueError"""
+    return coalesce_config(params.get("coalesce"), params.get("coalesce_ms"),
+                           params.get("coalesce_bytes"), env_prefix)
+
+
+_END = object()
+
+
+async def coalesce_deltas(source: AsyncIterable[str], cfg: CoalesceConfig) -> AsyncIterator[str]:
+    """
+    把上游的小增量合并成较大的块：时间窗口到期或字节数达到阈值就输出一次，顺序不变
+    上游由后台任务读取，这样上游停顿时已缓冲的内容也能按时发出
+    上游抛出的异常会在缓冲内容发出后原样抛出
+    """
+    if not cfg.enabled:
+        async for delta in source:
+            yield delta
+        return
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump():
+        try:
+            async for delta in source:
+                await queue.put(delta)
+        except Exception as e:
+            await queue.put((_END, e))
+        else:
+            await queue.put((_END, None))
+
+    pump_task = asyncio.create_task(pump())
+    window_s = cfg.window_ms / 1000.0
+    buf, size, deadline = [], 0, 0.0
+    try:
+        while True:
+            timeout = max(deadline - loop.time(), 0.0) if buf else None
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield "".join(buf)
+                buf, size = [], 0
+                continue
+
+            if isinstance(item, tuple) and item[0] is _END:
+                if buf:
+                    yield "".join(buf)
+                if item[1] is not None:
+                    raise item[1]
+                return
+
+            if not buf:
+                deadline = loop.time() + window_s
+            buf.append(item)
+            size += len(item.encode("utf-8"))
+            if cfg.max_bytes and size >= cfg.max_bytes:
+                yield "".join(buf)
+                buf, size = [], 0
+    finally:
+        # 消费方取消或提前退出时，连同上游一起停掉
+        pump_task.cancel()
+        try:
+            await pump_task
+        except BaseException:
+            pass
+
+
+async def with_heartbeat(source: AsyncIterable, interval_s: float) -> AsyncIterator:
+    """
+    透传 source 的元素；连续 interval_s 秒没有新元素时产出一个 None，供调用方发送心跳
+    上游异常原样抛出，消费方退出时上游一起停掉
+    interval_s <= 0 表示不发心跳，直接透传
+    """
+    if interval_s <= 0:
+        async for item in source:
+            yield item
+        return
+
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump():
+        try:
+            async for item in source:
+                await queue.put(item)
+        except Exception as e:
+            await queue.put((_END, e))
+        else:
+            await queue.put((_END, None))
+
+    pump_task = asyncio.create_task(pump())
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), interval_s)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if isinstance(item, tuple) and item and item[0] is _END:
+                if item[1] is not None:
+                    raise item[1]
+                return
+            yield item
+    finally:
+        pump_task.cancel()
+        try:
+            await pump_task
+        except BaseException:
+            pass
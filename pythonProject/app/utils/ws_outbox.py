@@ -0,0 +1,157 @@
+# ws_outbox.py
+import asyncio
+import json
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+# 全进程的慢消费者统计
+BACKPRESSURE_STATS: Dict[str, int] = {
+    "connections_hit": 0,      # 出现过队列满的连接数
+    "frames_coalesced": 0,     # 因队列满被合并进前一帧的 delta 数
+    "frames_dropped": 0,       # 因队列满被丢弃的 delta 数
+    "connections_closed": 0,   # 因慢消费被服务端关闭的连接数
+}
+
+
+class SlowConsumerError(Exception):
+    """连接因为发送队列溢出被关闭"""
+
+
+class WSOutbox:
+    """
+    每个 WebSocket 连接一个有界发送队列 + 一个写任务：
+    - 业务任务只往队列里放帧，不会被慢客户端的 send_text 卡住
+    - delta 帧数超过 max_frames 时按 policy 处理：
+        coalesce  合并进队列里同一 request_id 的上一帧 delta（index 取较大的那个）
+        drop      丢弃该 request_id 排队中的 delta，换成一帧 {"type":"dropped"} 汇总
+        close     以 close_code 关闭连接
+    - ack / result / error 等控制帧不能合并或丢弃，单独计数：超过 max_control 帧时不论 policy 都按 close 处理
+      （客户端只发请求不读响应时，错误帧也不会无限堆积）
+    """
+    def __init__(self, websocket, max_frames: int = 256, policy: str = "coalesce",
+                 close_code: int = 1013, max_control: int = 64):
+        self.websocket = websocket
+        self.max_frames = max_frames
+        self.max_control = max_control
+        self.policy = policy
+        self.close_code = close_code
+        self.closed = False
+        self._queue: Deque[Dict[str, Any]] = deque()
+        self._nonempty = asyncio.Event()
+        self._deltas = 0        # 队列中的 delta 帧数
+        self._controls = 0      # 队列中的其它帧数
+        self._hit = False
+        self._writer = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        try:
+            while True:
+                if not self._queue:
+                    self._nonempty.clear()
+                    await self._nonempty.wait()
+                    continue
+                frame = self._queue.popleft()
+                if frame.get("type") == "delta":
+                    self._deltas -= 1
+                else:
+                    self._controls -= 1
+                await self.websocket.send_text(json.dumps(frame))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.closed = True  # 连接已断开，之后的帧直接丢弃
+
+    async def send(self, frame: Dict[str, Any]) -> None:
+        if self.closed:
+            return
+        if frame.get("type") != "delta":
+            if self._controls < self.max_control:
+                self._push(frame)
+                return
+            await self._close()
+            raise SlowConsumerError("control queue overflow")
+        if self._deltas < self.max_frames:
+            self._push(frame)
+            return
+
+        # 队列已满：慢消费者
+        if not self._hit:
+            self._hit = True
+            BACKPRESSURE_STATS["connections_hit"] += 1
+        if self.policy == "coalesce":
+            if self._coalesce(frame):
+                BACKPRESSURE_STATS["frames_coalesced"] += 1
+            else:
+                self._push(frame)  # 该请求在队列里没有可合并的 delta，多放一帧，后续的会合并进来
+        elif self.policy == "drop":
+            self._drop(frame)
+        else:
+            await self._close()
+            raise SlowConsumerError("send queue overflow")
+
+    def _push(self, frame: Dict[str, Any]) -> None:
+        self._queue.append(frame)
+        if frame.get("type") == "delta":
+            self._deltas += 1
+        else:
+            self._controls += 1
+        self._nonempty.set()
+
+    def _last_frame(self, req_id: str, ftype: str) -> Optional[Dict[str, Any]]:
+        for queued in reversed(self._queue):
+            if queued.get("request_id") == req_id:
+                return queued if queued.get("type") == ftype else None
+        return None
+
+    def _coalesce(self, frame: Dict[str, Any]) -> bool:
+        prev = self._last_frame(frame.get("request_id"), "delta")
+        if prev is None:
+            return False
+        prev["data"]["delta"] += frame["data"]["delta"]
+        prev["data"]["index"] = frame["data"]["index"]
+        return True
+
+    def _drop(self, frame: Dict[str, Any]) -> None:
+        req_id = frame.get("request_id")
+        summary = self._last_frame(req_id, "dropped")
+        if summary is None:
+            summary = {"type": "dropped", "request_id": req_id,
+                       "data": {"frames": 0, "bytes": 0, "last_index": None}}
+            kept: Deque[Dict[str, Any]] = deque()
+            for queued in self._queue:
+                if queued.get("type") == "delta" and queued.get("request_id") == req_id:
+                    self._count_dropped(summary, queued)
+                    self._deltas -= 1
+                else:
+                    kept.append(queued)
+            self._queue = kept
+            self._push(summary)
+        self._count_dropped(summary, frame)
+
+    @staticmethod
+    def _count_dropped(summary: Dict[str, Any], frame: Dict[str, Any]) -> None:
+        data = summary["data"]
+        data["frames"] += 1
+        data["bytes"] += len(frame["data"]["delta"].encode("utf-8"))
+        data["last_index"] = frame["data"]["index"]
+        BACKPRESSURE_STATS["frames_dropped"] += 1
+
+    async def _close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        BACKPRESSURE_STATS["connections_closed"] += 1
+        self._writer.cancel()
+        try:
+            await self.websocket.close(code=self.close_code)
+        except Exception:
+            pass
+
+    async def aclose(self) -> None:
+        """连接结束时停止写任务"""
+        self.closed = True
+        self._writer.cancel()
+        try:
+            await self._writer
+        except BaseException:
+            pass